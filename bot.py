@@ -7,20 +7,45 @@ print("PYTHON VERSION:", sys.version)
 import os
 import asyncio
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.extensions import cursor as TupleCursor
+from psycopg2.pool import ThreadedConnectionPool
 import re
+import atexit
 import logging
-from datetime import datetime, timedelta
+import logging.handlers
+import queue
+import time
+import threading
+from datetime import datetime
 from contextlib import contextmanager
 from decimal import Decimal, ROUND_HALF_UP
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, ContextTypes, ConversationHandler
 )
 
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller; records are dropped if the writer falls behind"""
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+# Handlers run on a listener thread so slow stderr never stalls the event loop
+_log_queue = queue.Queue(maxsize=10_000)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[DroppingQueueHandler(_log_queue)],
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
@@ -31,16 +56,32 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 
 TELEGRAM_CHANNEL = os.getenv("TELEGRAM_CHANNEL", "@EarnXOfficiial")
 SUPPORT_USERNAME = "Mr_Carry07"
+_CHANNEL_URL = f"https://t.me/{TELEGRAM_CHANNEL.lstrip('@')}"
+_CHANNEL_CHAT = '@' + TELEGRAM_CHANNEL.lstrip('@')
+# Filled on first use, once the bot's username is known
+_ref_link_template = None
 
 # ==================== CONSTANTS ====================
 ALLOWED_DOMAINS = ["gmail.com"]
+_ALLOWED = frozenset(ALLOWED_DOMAINS)  # membership checks; the list keeps display order
 
 WITHDRAWAL_FEE_PERCENT = Decimal("5")
 WITHDRAWAL_FEE_MIN = Decimal("5")
+_FEE_FRACTION = WITHDRAWAL_FEE_PERCENT / Decimal("100")
+_CENT = Decimal("0.01")
 
 MAX_WITHDRAWALS_PER_DAY = 3
 MAX_PENDING_WITHDRAWALS = 2
 
+# Validation patterns, compiled once (used with fullmatch, so no anchors)
+# The email is split on '@' first and each half checked on its own, so no
+# pattern can backtrack across the separator
+_EMAIL_LOCAL_RE = re.compile(r'[a-zA-Z0-9._%+-]{1,64}')
+_EMAIL_DOMAIN_RE = re.compile(r'[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*\.[a-zA-Z]{2,}')
+_UPI_RE = re.compile(r'[\w.-]+@[\w]+')
+_USDT_RE = re.compile(r'0x[0-9a-fA-F]{40}')
+_NODOT = str.maketrans('', '', '.')  # normalize_email: Gmail ignores dots
+
 SUBMIT_COOLDOWN = 20  # seconds
 MAX_PAGINATION_PAGE = 50
 
@@ -49,24 +90,453 @@ ADMIN_USERS_PER_PAGE = 10
 ADMIN_GMAIL_PER_PAGE = 10  # Increased from 5
 ADMIN_WITHDRAWALS_PER_PAGE = 5
 
+# ==================== STATIC KEYBOARDS ====================
+# Built once at import; handlers only choose between them
+MAIN_MENU_KB = [
+    [InlineKeyboardButton("📧 Submit Gmail", callback_data="submit")],
+    [InlineKeyboardButton("📦 Bulk Submit (2-20)", callback_data="bulk_submit")],
+    [InlineKeyboardButton("💰 Balance", callback_data="balance"),
+     InlineKeyboardButton("📋 History", callback_data="history")],
+    [InlineKeyboardButton("💸 Withdraw", callback_data="withdraw"),
+     InlineKeyboardButton("👤 Profile", callback_data="profile")],
+    [InlineKeyboardButton("👥 Refer & Earn", callback_data="referral")],
+    [InlineKeyboardButton("📊 Earnings", callback_data="earnings")],
+    [InlineKeyboardButton("⚙️ Settings", callback_data="settings"),
+     InlineKeyboardButton("❓ Help", callback_data="help")]
+]
+ADMIN_MENU_ROW = [InlineKeyboardButton("⚙️ ADMIN", callback_data="admin")]
+MAIN_MENU_MARKUP = InlineKeyboardMarkup(MAIN_MENU_KB)
+MAIN_MENU_MARKUP_ADMIN = InlineKeyboardMarkup(MAIN_MENU_KB + [ADMIN_MENU_ROW])
+# /start variants for users who have not claimed the channel bonus yet
+CLAIM_CHANNEL_ROWS = [
+    [InlineKeyboardButton("📢 Join Channel", url=_CHANNEL_URL)],
+    [InlineKeyboardButton("🎁 Claim ₹1", callback_data="claim_channel")]
+]
+MAIN_MENU_MARKUP_UNCLAIMED = InlineKeyboardMarkup(CLAIM_CHANNEL_ROWS + MAIN_MENU_KB)
+MAIN_MENU_MARKUP_ADMIN_UNCLAIMED = InlineKeyboardMarkup(CLAIM_CHANNEL_ROWS + MAIN_MENU_KB + [ADMIN_MENU_ROW])
+
+EARNINGS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Today", callback_data="earnings_today"),
+     InlineKeyboardButton("📅 Week", callback_data="earnings_week")],
+    [InlineKeyboardButton("📅 Month", callback_data="earnings_month"),
+     InlineKeyboardButton("📅 All Time", callback_data="earnings_all")],
+    [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+])
+
+# History row labels by status: (emoji, title)
+STATUS_LABELS = {"pending": ("⏳", "Pending"), "approved": ("✅", "Approved"), "rejected": ("❌", "Rejected")}
+
+# Fixed rows under the history pages
+BACK_TO_MENU_ROW = [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+GMAIL_HISTORY_ROW = [InlineKeyboardButton("📧 Gmail History", callback_data="history_gmail_0")]
+WITHDRAWAL_HISTORY_ROW = [InlineKeyboardButton("💸 Withdrawal History", callback_data="history_withdrawal_0")]
+
+SETUP_PAYMENT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📱 UPI", callback_data="set_upi")],
+    [InlineKeyboardButton("💎 USDT", callback_data="set_usdt")],
+    [InlineKeyboardButton("🔙 Back", callback_data="withdraw")]
+])
+
+def _settings_markup(notif):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔕 Disable" if notif else "🔔 Enable", callback_data="toggle_notif")],
+        [InlineKeyboardButton("📜 Terms", callback_data="view_terms")],
+        [InlineKeyboardButton("📞 Support", url=f"https://t.me/{SUPPORT_USERNAME}")],
+        [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+    ])
+
+SETTINGS_MARKUP_ON = _settings_markup(True)
+SETTINGS_MARKUP_OFF = _settings_markup(False)
+
+def _withdraw_markup(upi, usdt):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📱 UPI" + (" ✅" if upi else ""), callback_data="withdraw_upi")],
+        [InlineKeyboardButton("💎 USDT" + (" ✅" if usdt else ""), callback_data="withdraw_usdt")],
+        [InlineKeyboardButton("⚙️ Setup Payment", callback_data="setup_payment")],
+        [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+    ])
+
+# Withdraw method picker, keyed by (UPI set up, USDT set up)
+WITHDRAW_MARKUPS = {(upi, usdt): _withdraw_markup(upi, usdt)
+                    for upi in (False, True) for usdt in (False, True)}
+REFERRAL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏆 Leaderboard", callback_data="referral_leaderboard")],
+    [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+])
+PROFILE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚙️ Payment Methods", callback_data="setup_payment")],
+    [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+])
+TERMS_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="settings")]])
+HELP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📞 Contact Support", url=f"https://t.me/{SUPPORT_USERNAME}")],
+    [InlineKeyboardButton("🔙 Back", callback_data="menu")]
+])
+ADMIN_PANEL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📧 Gmail Queue", callback_data="gmail_queue")],
+    [InlineKeyboardButton("💸 Withdrawals", callback_data="withdrawal_queue")],
+    [InlineKeyboardButton("👥 User Management", callback_data="user_mgmt")],
+    [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast")],
+    [InlineKeyboardButton("📊 Statistics", callback_data="stats"),
+     InlineKeyboardButton("🔙 Back", callback_data="menu")]
+])
+
+# Single-button navigation keyboards
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="menu")]])
+MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Menu", callback_data="menu")]])
+MAIN_MENU_BUTTON_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Main Menu", callback_data="menu")]])
+BACK_TO_PROFILE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Profile", callback_data="profile")]])
+BACK_TO_REFERRAL_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="referral")]])
+BACK_TO_ADMIN_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="admin")]])
+ADMIN_BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Admin", callback_data="admin")]])
+ADMIN_PANEL_BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]])
+BACK_TO_GMAIL_QUEUE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Queue", callback_data="gmail_queue_0")]])
+
+# ==================== STATIC TEXT ====================
+# Depends only on the constants above, so it is formatted once at import
+TERMS_TEXT = f"""Terms & Conditions
+
+1. Submit only your own accounts
+2. No fake or stolen accounts
+3. Minimum withdrawal: ₹100
+4. Maximum {MAX_WITHDRAWALS_PER_DAY} withdrawals per day
+5. Withdrawal fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
+6. Processing time: 24-48 hours
+7. Only {', '.join(ALLOWED_DOMAINS)} allowed
+8. Referral rewards after first verified submission
+9. Suspicious activity will result in account suspension
+
+Support: @{SUPPORT_USERNAME}"""
+
+# Templates for the dynamic panels, filled with str.format
+PROFILE_TPL = """Profile
+
+Status: {status_label}
+Balance: ₹{bal:.2f}
+Current rate: ₹{rate} per account
+
+Approved submissions (all time): {approved}
+This week: {weekly_approvals} approvals
+Successful referrals: {ref_count}
+
+Payment methods:
+UPI: {upi}
+USDT: {usdt}
+
+Joined: {joined:%Y-%m-%d}
+
+Note: Your rate is based on last 7 days activity"""
+SETUP_LABELS = ("❌ Not setup", "✅ Setup")
+
+# /start text; the constants are rendered once here, only the name per call
+WELCOME_TPL = f"""Welcome {{name}}
+
+Earn money by submitting Gmail accounts.
+
+Rates per account (based on last 7 days):
+- 0-99 approvals: ₹20
+- 100-199 approvals: ₹25
+- 200+ approvals: ₹30
+
+Bonus earnings:
+- Join channel: ₹1 (one-time)
+- Refer friends: ₹5 per person
+
+Withdrawal fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
+
+Note: Your rate updates automatically based on weekly activity. Stay active to maintain higher tiers!
+
+Join our channel: {TELEGRAM_CHANNEL}"""
+WELCOME_UNCLAIMED_TPL = WELCOME_TPL + "\n\n⚡ Join channel to claim ₹1 bonus"
+
+ADMIN_PANEL_TPL = """Admin Panel
+
+Total users: {users}
+Pending Gmail: {pg}
+Pending withdrawals: {pw}"""
+
+USER_GMAIL_HEADER_TPL = """Gmail Review - {name}
+
+User: @{username} (ID: {uid})
+Total pending: {total_pending}
+Page {page} of {total_pages}
+
+"""
+USER_GMAIL_ITEM_TPL = """{idx}. Gmail #{gid}
+{email}
+{pwd}
+₹{reward}
+
+"""
+
+# Admin alerts for new submissions and withdrawal requests
+ADMIN_NEW_GMAIL_TPL = """New Gmail Submission
+
+User: {name} (@{username})
+User ID: {uid}
+
+Email: {email}
+Password: {pwd}
+Reward: ₹{reward}"""
+ADMIN_BULK_GMAIL_TPL = """Bulk Gmail Submission
+
+User: {name} (@{username})
+User ID: {uid}
+Count: {count} accounts
+Reward: ₹{reward} each
+
+"""
+ADMIN_NEW_WITHDRAWAL_TPL = """New Withdrawal Request
+
+User: {name}
+User ID: {uid}
+
+Amount: ₹{amount:.2f}
+Fee: ₹{fee:.2f}
+Final: ₹{final:.2f}
+Method: {method}
+Payment info: {payment_info}"""
+
+_SETTINGS_TPL = """Settings
+
+Notifications: {state}
+
+Support: @{support}
+Terms & Conditions: Click below"""
+SETTINGS_TEXT_ON = _SETTINGS_TPL.format(state="🔔 Enabled", support=SUPPORT_USERNAME)
+SETTINGS_TEXT_OFF = _SETTINGS_TPL.format(state="🔕 Disabled", support=SUPPORT_USERNAME)
+
+HELP_TEXT = f"""📜 Help & Support – EarnX Bot
+
+📌 How it works:
+1️⃣ Submit Gmail accounts (single or bulk)
+2️⃣ Accounts go under review (24–48 hours)
+3️⃣ Approved accounts earn rewards
+4️⃣ Withdraw once balance reaches ₹100
+
+📦 Gmail Submission:
+• Single & Bulk submission supported
+• Bulk limit: 2–20 Gmail per message
+• Only gmail.com allowed
+• Duplicate / fake Gmail = rejected
+
+💰 Reward System (Rolling 7-Day Activity):
+Rates depend on LAST 7 DAYS approved Gmail:
+• 0–99 approvals → ₹20 per Gmail
+• 100–199 approvals → ₹25 per Gmail
+• 200+ approvals → ₹30 per Gmail
+
+⚠️ Important:
+• Rates are NOT lifetime locked
+• Inactivity may reduce your rate
+• Stay active to keep higher earnings
+
+🎁 Bonus Earnings:
+• Channel join: ₹1
+• Referral: ₹5 per friend
+  (after first verified submission)
+
+💵 Withdrawals:
+• Minimum: ₹100
+• Fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
+• Limit: {MAX_WITHDRAWALS_PER_DAY} per day
+• Methods: UPI & USDT (BEP20)
+• Processing: 24–48 hours
+
+🔒 Fair Usage Policy:
+• One user = one account
+• Abuse may lead to ban
+• Admin decision is final
+
+Allowed emails:
+- {', '.join(ALLOWED_DOMAINS)}
+
+📩 Need help? Contact support:
+@{SUPPORT_USERNAME}"""
+
+# Per-user values read on nearly every update. cachetools caches are not
+# thread-safe, so all access goes through _cache_lock.
+USER_CACHE_TTL = 60  # seconds
+_cache_lock = threading.Lock()
+_blocked_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+_notif_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+_rate_cache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL)
+_withdraw_today_cache = TTLCache(maxsize=10_000, ttl=5)
+# Admin panel totals; dropped whenever a pending Gmail or withdrawal changes,
+# so the TTL mostly covers new users
+_admin_counts_cache = TTLCache(maxsize=1, ttl=10)
+
+# Keeps outgoing notifications under Telegram's ~30 msg/s bot-wide limit
+_send_limiter = AsyncLimiter(25, 1)
+BROADCAST_BATCH_SIZE = 500
+# Users who blocked the bot (Telegram answers 403). Sends to them are skipped
+# until they /start again; persisted in users.bot_blocked for broadcasts.
+_unreachable_users = set()
+# Channel membership: "not a member" expires quickly so a user who just
+# joined can claim right away
+_channel_member_cache = TTLCache(maxsize=50_000, ttl=600)
+_channel_nonmember_cache = TTLCache(maxsize=50_000, ttl=10)
+# Users known to hold the one-time channel bonus; never changes back
+_channel_claimed_users = set()
+
 EMAIL, PASSWORD, USDT_ADDRESS, UPI_ID, WITHDRAW_AMT, BROADCAST_MSG, USER_SEARCH, BULK_GMAIL, WALLET_AMOUNT, WALLET_REASON = range(10)
 
+# Hot statements are parsed and planned once per pooled session
+PREPARED_STATEMENTS = (
+    """PREPARE p_user_meta (bigint) AS
+       SELECT is_blocked, notifications_enabled, approved_gmail,
+              EXTRACT(EPOCH FROM NOW() - last_submit_time) AS since_last_submit
+       FROM users WHERE user_id=$1""",
+    # Inserts the submission and bumps the user's counters; returns no row
+    # (and changes nothing) when the email's key ($5) was already submitted
+    """PREPARE p_gmail_insert (bigint, text, text, numeric, text) AS
+       WITH g AS (
+           INSERT INTO gmail (user_id, email, password, reward, submit_date, email_key)
+           VALUES ($1, $2, $3, $4, NOW(), $5)
+           ON CONFLICT (email_key) DO NOTHING RETURNING id
+       ), u AS (
+           UPDATE users SET total_gmail = total_gmail + 1, last_submit_time = NOW()
+           WHERE user_id = $1 AND EXISTS (SELECT 1 FROM g)
+       )
+       SELECT id FROM g""",
+    """PREPARE p_withdraw_today_count (bigint) AS
+       SELECT COUNT(*) AS n FROM withdrawals
+       WHERE user_id=$1 AND request_date >= date_trunc('day', NOW())
+       AND status IN ('pending', 'approved')""",
+    # Balance check, atomic deduction and request insert for a withdrawal.
+    # u sees the balance from before the deduction; the UPDATE re-checks it
+    # under the row lock.
+    """PREPARE p_withdraw_submit (bigint, numeric, numeric, numeric, text) AS
+       WITH u AS (
+           SELECT balance, upi_id, usdt_address FROM users WHERE user_id = $1
+       ), d AS (
+           UPDATE users SET balance = balance - $2
+           WHERE user_id = $1 AND balance >= $2
+           RETURNING balance
+       ), w AS (
+           INSERT INTO withdrawals (user_id, amount, fee, final_amount, method, payment_info, request_date)
+           SELECT $1, $2, $3, $4, $5,
+                  CASE WHEN $5 = 'upi' THEN u.upi_id ELSE u.usdt_address END, NOW()
+           FROM u, d
+           RETURNING id, payment_info
+       )
+       SELECT u.balance, w.id, w.payment_info FROM u LEFT JOIN w ON TRUE""",
+    # Active offer (if any) and the user's approvals over the last 7 days
+    """PREPARE p_rate (bigint) AS
+       SELECT (SELECT rate FROM rate_rules
+               WHERE is_active = TRUE AND start_time <= NOW() AND end_time >= NOW()
+               ORDER BY rate DESC LIMIT 1) AS offer,
+              (SELECT COUNT(*) FROM gmail
+               WHERE user_id = $1 AND status = 'approved'
+               AND review_date >= NOW() - INTERVAL '7 days') AS n""",
+    # Per-tap panel reads
+    """PREPARE p_balance_panel (bigint) AS
+       SELECT u.balance, u.total_gmail, u.approved_gmail,
+              COALESCE((SELECT SUM(reward) FROM gmail
+                        WHERE user_id = u.user_id AND status = 'pending'), 0) AS pending,
+              (SELECT COUNT(*) FROM gmail
+               WHERE user_id = u.user_id
+               AND status = 'approved'
+               AND review_date >= NOW() - INTERVAL '7 days') AS weekly_approvals
+       FROM users u WHERE u.user_id = $1""",
+    """PREPARE p_withdraw_panel (bigint) AS
+       SELECT u.balance, u.usdt_address, u.upi_id,
+              (SELECT COUNT(*) FROM withdrawals w
+               WHERE w.user_id = u.user_id AND w.status = 'pending') AS pending_count,
+              (SELECT COUNT(*) FROM withdrawals w
+               WHERE w.user_id = u.user_id
+               AND w.request_date >= date_trunc('day', NOW())
+               AND w.status IN ('pending', 'approved')) AS today_count
+       FROM users u WHERE u.user_id = $1""",
+    """PREPARE p_profile_panel (bigint) AS
+       SELECT u.balance, u.approved_gmail, u.usdt_address, u.upi_id, u.joined_date,
+              (SELECT COUNT(*) FROM referrals r
+               WHERE r.referrer_id = u.user_id AND r.rewarded = 1) AS ref_count,
+              (SELECT COUNT(*) FROM gmail g
+               WHERE g.user_id = u.user_id
+               AND g.status = 'approved'
+               AND g.review_date >= NOW() - INTERVAL '7 days') AS weekly_approvals
+       FROM users u WHERE u.user_id = $1""",
+    """PREPARE p_toggle_block (bigint) AS
+       UPDATE users SET is_blocked = 1 - is_blocked WHERE user_id=$1
+       RETURNING is_blocked""",
+)
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Pooled connection that remembers whether its session is prepared"""
+    prepared = False
+
+# Connections are reused across handlers instead of reconnecting per query
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "25"))
+# A stuck query must not hold a pooled connection (and a worker thread) forever
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "60000"))
+db_pool = ThreadedConnectionPool(
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX,
+    dsn=DATABASE_URL,
+    # JIT compilation only adds latency to the bot's short queries
+    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS} -c jit=off",
+    connection_factory=PreparedConnection,
+    cursor_factory=RealDictCursor
+)
+# The pool raises instead of waiting when exhausted, so worker threads
+# queue here for a free connection
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
 @contextmanager
-def get_db():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+def get_db(prepare=True):
+    _pool_slots.acquire()
+    try:
+        conn = db_pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
     try:
+        if prepare and not conn.prepared:
+            # PREPARE is not transactional, so these ride along with the
+            # caller's transaction instead of committing separately. For the
+            # same reason a run that failed partway leaves its statements on
+            # the session even after the rollback, so start from a clean slate
+            c = conn.cursor()
+            c.execute("DEALLOCATE ALL")
+            for statement in PREPARED_STATEMENTS:
+                c.execute(statement)
+            conn.prepared = True
         yield conn
         conn.commit()
     except Exception as e:
-        conn.rollback()
+        if not conn.closed:
+            conn.rollback()
         logger.error(f"Database error: {e}")
         raise
     finally:
-        conn.close()
+        # Drop broken connections so the pool replaces them
+        db_pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
+
+async def db_run(fn, *args):
+    """Run blocking database work in a worker thread, off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def cache_get(cache, key):
+    with _cache_lock:
+        return cache.get(key)
+
+def cache_set(cache, key, value):
+    with _cache_lock:
+        cache[key] = value
+
+def cache_invalidate(cache, key):
+    with _cache_lock:
+        cache.pop(key, None)
 
 def init_db():
-    with get_db() as conn:
+    # Tables may not exist yet, so this session must not prepare statements
+    with get_db(prepare=False) as conn:
         c = conn.cursor()
+        # Column type migrations can outlast the per-query limit on big tables
+        c.execute("SET LOCAL statement_timeout = 0")
         
         # Users table
         c.execute('''CREATE TABLE IF NOT EXISTS users (
@@ -80,11 +550,12 @@ def init_db():
             referrer_id BIGINT,
             usdt_address TEXT,
             upi_id TEXT,
-            joined_date TEXT,
+            joined_date TIMESTAMPTZ,
             channel_claimed INTEGER DEFAULT 0,
-            last_submit_time TEXT,
+            last_submit_time TIMESTAMPTZ,
             terms_accepted INTEGER DEFAULT 1,
-            notifications_enabled INTEGER DEFAULT 1
+            notifications_enabled INTEGER DEFAULT 1,
+            bot_blocked INTEGER DEFAULT 0
         )''')
         
         # Gmail submissions table
@@ -95,9 +566,10 @@ def init_db():
             password TEXT,
             status TEXT DEFAULT 'pending',
             reward DECIMAL(10,2),
-            submit_date TEXT,
-            review_date TEXT,
+            submit_date TIMESTAMPTZ,
+            review_date TIMESTAMPTZ,
             rejection_reason TEXT,
+            email_key TEXT,
             UNIQUE(email)
         )''')
         
@@ -111,8 +583,8 @@ def init_db():
             method TEXT,
             payment_info TEXT,
             status TEXT DEFAULT 'pending',
-            request_date TEXT,
-            processed_date TEXT,
+            request_date TIMESTAMPTZ,
+            processed_date TIMESTAMPTZ,
             rejection_reason TEXT
         )''')
         
@@ -122,7 +594,7 @@ def init_db():
             referrer_id BIGINT,
             referred_id BIGINT,
             reward DECIMAL(10,2) DEFAULT 5,
-            date TEXT,
+            date TIMESTAMPTZ,
             rewarded INTEGER DEFAULT 0,
             UNIQUE(referred_id)
         )''')
@@ -134,7 +606,7 @@ def init_db():
             admin_id BIGINT,
             target_user_id BIGINT,
             details TEXT,
-            timestamp TEXT
+            timestamp TIMESTAMPTZ
         )''')
         # Admin wallet logs table
         c.execute('''CREATE TABLE IF NOT EXISTS admin_wallet_logs (
@@ -146,49 +618,131 @@ def init_db():
             reason TEXT NOT NULL,
             balance_before DECIMAL(10,2) NOT NULL,
             balance_after DECIMAL(10,2) NOT NULL,
-            timestamp TEXT NOT NULL
+            timestamp TIMESTAMPTZ NOT NULL
         )''')
         # Add missing columns
         columns_to_add = [
             ("users", "notifications_enabled", "INTEGER DEFAULT 1"),
-            ("users", "last_submit_time", "TEXT"),
-            ("gmail", "review_date", "TEXT"),
+            ("users", "bot_blocked", "INTEGER DEFAULT 0"),
+            ("users", "last_submit_time", "TIMESTAMPTZ"),
+            ("gmail", "review_date", "TIMESTAMPTZ"),
             ("gmail", "rejection_reason", "TEXT"),
-            ("withdrawals", "processed_date", "TEXT"),
+            ("withdrawals", "processed_date", "TIMESTAMPTZ"),
             ("withdrawals", "rejection_reason", "TEXT"),
             ("withdrawals", "fee", "DECIMAL(10,2) DEFAULT 0"),
             ("withdrawals", "final_amount", "DECIMAL(10,2)"),
-            ("referrals", "rewarded", "INTEGER DEFAULT 0")
+            ("referrals", "rewarded", "INTEGER DEFAULT 0"),
+            ("gmail", "email_key", "TEXT")
         ]
         
+        # One catalog query instead of probing each column (a failed probe
+        # aborts the whole transaction)
+        c.execute("""SELECT table_name, column_name, data_type FROM information_schema.columns
+                     WHERE table_schema='public'
+                     AND table_name IN ('users', 'gmail', 'withdrawals', 'referrals',
+                                        'audit_log', 'admin_wallet_logs')""")
+        existing = {(row['table_name'], row['column_name']): row['data_type'] for row in c.fetchall()}
+        
         for table, column, definition in columns_to_add:
-            try:
-                c.execute(f"SELECT {column} FROM {table} LIMIT 1")
-            except psycopg2.Error:
+            if (table, column) not in existing:
                 logger.info(f"Adding {column} column to {table} table")
-                c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
-                conn.commit()
+                c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+        
+        # Older deployments stored these as ISO text, which defeats range
+        # filters and the indexes on them
+        timestamp_columns = [
+            ("users", "last_submit_time"),
+            ("users", "joined_date"),
+            ("gmail", "submit_date"),
+            ("gmail", "review_date"),
+            ("withdrawals", "request_date"),
+            ("withdrawals", "processed_date"),
+            ("referrals", "date"),
+            ("audit_log", "timestamp"),
+            ("admin_wallet_logs", "timestamp")
+        ]
+        
+        for table, column in timestamp_columns:
+            if existing.get((table, column)) == 'text':
+                logger.info(f"Converting {table}.{column} to TIMESTAMPTZ")
+                c.execute(f"""ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ
+                              USING NULLIF({column}, '')::timestamptz""")
         
         # Create indexes for performance
+        # (name, table, columns[, INCLUDE / WHERE clause])
         indexes = [
             ("idx_gmail_user_status", "gmail", "user_id, status"),
             ("idx_gmail_status", "gmail", "status"),
-            ("idx_gmail_email", "gmail", "email"),
-            ("idx_withdrawals_user_status", "withdrawals", "user_id, status"),
+            # Keyset pagination of a user's submission history
+            ("idx_gmail_user_submit", "gmail", "user_id, submit_date DESC, id DESC"),
+            # Pending totals per user, and the admin review pages in
+            # submission order without a sort
+            ("idx_gmail_user_pending_queue", "gmail", "user_id, submit_date, id",
+             "INCLUDE (reward) WHERE status='pending'"),
+            # First-approval check on the approve path, and the rolling
+            # 7-day / earnings-period approval counts
+            ("idx_gmail_approved_user_review", "gmail", "user_id, review_date", "WHERE status='approved'"),
+            ("idx_withdrawals_user_pending", "withdrawals", "user_id, request_date",
+             "WHERE status IN ('pending', 'approved')"),
             ("idx_withdrawals_status", "withdrawals", "status"),
+            # Admin withdrawal queue, oldest first; only pending rows, so the
+            # queue count and page lookup stay small as history grows
+            ("idx_withdrawals_pending_queue", "withdrawals", "request_date, id", "WHERE status='pending'"),
             ("idx_withdrawals_date", "withdrawals", "request_date"),
+            # Keyset pagination of a user's withdrawal history
+            ("idx_withdrawals_user_date", "withdrawals", "user_id, request_date DESC, id DESC"),
             ("idx_referrals_referrer", "referrals", "referrer_id"),
             ("idx_referrals_rewarded", "referrals", "rewarded"),
-            ("idx_users_blocked", "users", "is_blocked")
+            ("idx_users_blocked", "users", "is_blocked"),
+            # Lets the per-user flag lookups run as index-only scans
+            ("idx_users_meta", "users", "user_id",
+             "INCLUDE (is_blocked, notifications_enabled, approved_gmail, last_submit_time, balance)")
         ]
         
-        for idx_name, table, columns in indexes:
-            try:
-                c.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON {table}({columns})")
-            except Exception as e:
-                logger.error(f"Error creating index {idx_name}: {e}")
+        # All index DDL goes to the server in one round trip
+        # (idx_withdrawals_user_status is superseded by idx_withdrawals_user_pending,
+        # idx_withdrawals_pending_date by idx_withdrawals_pending_queue)
+        # (idx_gmail_email duplicated the UNIQUE(email) constraint's index,
+        # idx_gmail_approved_user is superseded by idx_gmail_approved_user_review,
+        # idx_gmail_user_pending_reward by idx_gmail_user_pending_queue)
+        ddl = ["DROP INDEX IF EXISTS idx_withdrawals_user_status;",
+               "DROP INDEX IF EXISTS idx_withdrawals_pending_date;",
+               "DROP INDEX IF EXISTS idx_gmail_email;",
+               "DROP INDEX IF EXISTS idx_gmail_approved_user;",
+               "DROP INDEX IF EXISTS idx_gmail_user_pending_reward;"]
+        ddl += [f"CREATE INDEX IF NOT EXISTS {idx_name} ON {table}({columns}) {' '.join(options)};"
+                for idx_name, table, columns, *options in indexes]
+        c.execute("\n".join(ddl))
+        
+        # email_key is normalize_email(email) and its unique index makes the
+        # INSERT the source of truth for duplicates. Rows stored before the
+        # column existed are keyed here with the same rules in SQL; a legacy
+        # row whose key an older row already holds keeps NULL, so the index
+        # can always be built.
+        c.execute("""UPDATE gmail g SET email_key = k.key
+                     FROM (SELECT id, key, ROW_NUMBER() OVER (PARTITION BY key ORDER BY id) AS rn
+                           FROM (SELECT id,
+                                        CASE WHEN split_part(lower(btrim(email)), '@', 2) = 'gmail.com'
+                                             THEN replace(split_part(split_part(lower(btrim(email)), '@', 1),
+                                                                     '+', 1), '.', '') || '@gmail.com'
+                                             ELSE lower(btrim(email)) END AS key
+                                 FROM gmail WHERE email_key IS NULL) s) k
+                     WHERE g.id = k.id AND k.rn = 1
+                     AND NOT EXISTS (SELECT 1 FROM gmail o WHERE o.email_key = k.key)""")
+        c.execute("SELECT COUNT(*) AS n FROM gmail WHERE email_key IS NULL")
+        unkeyed = c.fetchone()['n']
+        if unkeyed:
+            logger.warning(f"{unkeyed} legacy gmail rows duplicate an older submission; left without email_key")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_gmail_email_key ON gmail(email_key)")
+        
+        # Pending submissions per user for the admin Gmail queue; the unique
+        # index is what allows REFRESH ... CONCURRENTLY
+        c.execute("""CREATE MATERIALIZED VIEW IF NOT EXISTS mv_gmail_pending_by_user AS
+                     SELECT user_id, COUNT(*) AS cnt FROM gmail
+                     WHERE status='pending' GROUP BY user_id""")
+        c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_gmail_pending_user
+                     ON mv_gmail_pending_by_user(user_id)""")
         
-        conn.commit()
         # ==================== SYSTEM CONTROL TABLES ====================
 
 # Temporary rate offers (24h / festival / promo)
@@ -234,19 +788,25 @@ ON CONFLICT (key) DO NOTHING
 
 def round_decimal(value):
     """Round to 2 decimal places properly"""
-    return Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(_CENT, rounding=ROUND_HALF_UP)
 
 def normalize_email(email):
     """Normalize email for duplicate detection"""
     if not email:
         return email
     email = email.lower().strip()
-    local, domain = email.split('@', 1)
-    # Remove dots and plus aliases from Gmail local part
+    at = email.rfind('@')
+    if at < 0:
+        return email
+    local, domain = email[:at], email[at + 1:]
+    # Remove plus aliases and dots from Gmail local part
     if domain == 'gmail.com':
-        local = local.replace('.', '')
-        if '+' in local:
-            local = local.split('+')[0]
+        plus = local.find('+')
+        if plus >= 0:
+            local = local[:plus]
+        local = local.translate(_NODOT)
     return f"{local}@{domain}"
 
 def validate_email(email):
@@ -256,12 +816,17 @@ def validate_email(email):
     
     email = email.lower().strip()
     
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(pattern, email):
+    if email.count('@') != 1:
+        return False, "Invalid email format"
+    
+    local, domain = email.split('@')
+    if not _EMAIL_LOCAL_RE.fullmatch(local):
         return False, "Invalid email format"
     
-    domain = email.split('@')[-1].lower()
-    if domain not in ALLOWED_DOMAINS:
+    # Allowed domains are known to be well-formed; only others need the pattern
+    if domain not in _ALLOWED:
+        if not _EMAIL_DOMAIN_RE.fullmatch(domain):
+            return False, "Invalid email format"
         return False, f"Only {', '.join(ALLOWED_DOMAINS)} allowed"
     
     return True, email
@@ -272,20 +837,12 @@ def validate_password(password):
 def validate_upi(upi_id):
     if not upi_id or len(upi_id) > 50:
         return False
-    pattern = r'^[\w.-]+@[\w]+$'
-    return bool(re.match(pattern, upi_id))
+    return bool(_UPI_RE.fullmatch(upi_id))
 
 def validate_usdt_address(address):
     if not address or len(address) != 42:
         return False
-    if not address.startswith('0x'):
-        return False
-    # Validate hexadecimal characters after 0x
-    try:
-        int(address[2:], 16)
-        return True
-    except ValueError:
-        return False
+    return bool(_USDT_RE.fullmatch(address))
 
 def mask_email(email):
     """Mask email for privacy"""
@@ -311,83 +868,305 @@ def validate_page(page_str):
     except:
         return 0
 
+def parse_history_cursor(data):
+    """
+    Split 'history_<kind>_<page>_<a|b><id>' callback data into
+    (page, direction, anchor id). 'a' pages to rows older than the anchor
+    row, 'b' to rows newer than it; without a cursor the first page is shown.
+    """
+    parts = data.split("_")
+    cursor = parts[3] if len(parts) > 3 else ""
+    if cursor[:1] in ("a", "b") and cursor[1:].isdigit():
+        return validate_page(parts[2]), cursor[0], int(cursor[1:])
+    return 0, None, None
+
+def fetch_history_page(c, table, columns, date_col, user_id, direction=None, anchor=None, size=5):
+    """
+    Keyset page of a user's rows, newest first. Fetches one extra row to
+    know whether another page exists, so no COUNT or OFFSET is needed.
+    Returns (rows, has_prev, has_next).
+    """
+    base = f"SELECT id, {columns} FROM {table} WHERE user_id=%s"
+    anchor_row = f"(SELECT {date_col}, id FROM {table} WHERE id=%s)"
+    
+    if direction == 'b':
+        c.execute(f"""{base} AND ({date_col}, id) > {anchor_row}
+                      ORDER BY {date_col}, id LIMIT %s""", (user_id, anchor, size + 1))
+        rows = c.fetchall()
+        if len(rows) > size:
+            return rows[size - 1::-1], True, True
+        # Not a full page of newer rows left, so show the first page
+    elif direction == 'a':
+        c.execute(f"""{base} AND ({date_col}, id) < {anchor_row}
+                      ORDER BY {date_col} DESC, id DESC LIMIT %s""", (user_id, anchor, size + 1))
+        rows = c.fetchall()
+        return rows[:size], True, len(rows) > size
+    
+    c.execute(f"{base} ORDER BY {date_col} DESC, id DESC LIMIT %s", (user_id, size + 1))
+    rows = c.fetchall()
+    return rows[:size], False, len(rows) > size
+
+# Writers only flag the pending-by-user view as stale; the admin queue
+# refreshes it on read, at most once per interval for user submissions
+GMAIL_QUEUE_REFRESH_INTERVAL = 2  # seconds
+_gmail_queue_state = {"stale": True, "refreshed_at": 0.0}
+
+def mark_gmail_queue_stale(immediate=False):
+    """Call after committing a Gmail insert or review; immediate skips the throttle"""
+    _gmail_queue_state["stale"] = True
+    cache_invalidate(_admin_counts_cache, "admin")
+    if immediate:
+        _gmail_queue_state["refreshed_at"] = 0.0
+
+def refresh_gmail_queue_view(c):
+    """Refresh mv_gmail_pending_by_user if it is stale and the throttle allows"""
+    now = time.monotonic()
+    if not _gmail_queue_state["stale"] or now - _gmail_queue_state["refreshed_at"] < GMAIL_QUEUE_REFRESH_INTERVAL:
+        return
+    # Cleared first so writes committed during the refresh flag it again
+    _gmail_queue_state.update(stale=False, refreshed_at=now)
+    try:
+        c.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_gmail_pending_by_user")
+    except Exception:
+        _gmail_queue_state["stale"] = True
+        raise
+
+def fetch_user_gmail_panel(c, uid, page):
+    """
+    Returns (gmails, total_pending, user_info) for the admin review panel.
+    One round trip: the owner row carries the pending total and is joined to
+    the page of pending submissions (a single NULL-id row when there are none).
+    """
+    c.execute("""SELECT u.first_name, u.username,
+                        (SELECT COUNT(*) FROM gmail
+                         WHERE user_id = u.user_id AND status='pending') AS total_pending,
+                        g.id, g.email, g.password, g.reward
+                 FROM users u
+                 LEFT JOIN LATERAL (
+                     SELECT id, email, password, reward, submit_date
+                     FROM gmail WHERE user_id = u.user_id AND status='pending' 
+                     ORDER BY submit_date ASC, id
+                     LIMIT %s OFFSET %s
+                 ) g ON TRUE
+                 WHERE u.user_id = %s
+                 ORDER BY g.submit_date, g.id""", (ADMIN_GMAIL_PER_PAGE, page * ADMIN_GMAIL_PER_PAGE, uid))
+    rows = c.fetchall()
+    if not rows:
+        return [], 0, None
+    gmails = [row for row in rows if row['id'] is not None]
+    return gmails, rows[0]['total_pending'], rows[0]
+
+def render_user_gmail(uid, page, gmails, total_pending, user_info):
+    """Text and markup of one user's pending Gmail review page"""
+    name, username = user_info['first_name'], user_info['username']
+    total_pages = (total_pending + ADMIN_GMAIL_PER_PAGE - 1) // ADMIN_GMAIL_PER_PAGE
+    
+    text = USER_GMAIL_HEADER_TPL.format(name=name, username=username or 'N/A', uid=uid,
+                                        total_pending=total_pending, page=page + 1, total_pages=total_pages)
+    text += "".join(USER_GMAIL_ITEM_TPL.format(idx=idx, gid=g['id'], email=g['email'],
+                                               pwd=g['password'], reward=float(g['reward']))
+                    for idx, g in enumerate(gmails, 1))
+    
+    kb = []
+    
+    # Batch action buttons
+    kb.append([
+        InlineKeyboardButton("✅ Approve All", callback_data=f"approve_all_{uid}"),
+        InlineKeyboardButton("❌ Reject All", callback_data=f"reject_all_{uid}")
+    ])
+    
+    # Individual Gmail buttons
+    for gmail in gmails:
+        gid = gmail['id']
+        kb.append([
+            InlineKeyboardButton(f"✅ Approve #{gid}", callback_data=f"approve_{gid}_{uid}_{page}"),
+            InlineKeyboardButton(f"❌ Reject #{gid}", callback_data=f"reject_{gid}_{uid}_{page}")
+        ])
+    
+    # Pagination buttons
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"user_gmail_{uid}_{page-1}"))
+    if (page + 1) * ADMIN_GMAIL_PER_PAGE < total_pending:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"user_gmail_{uid}_{page+1}"))
+    
+    if nav_buttons:
+        kb.append(nav_buttons)
+    
+    # Back button
+    kb.append([InlineKeyboardButton("🔙 Back", callback_data="gmail_queue_0")])
+    return text, InlineKeyboardMarkup(kb)
+
+def render_settings(notif):
+    """Text and markup of the settings screen"""
+    if notif:
+        return SETTINGS_TEXT_ON, SETTINGS_MARKUP_ON
+    return SETTINGS_TEXT_OFF, SETTINGS_MARKUP_OFF
+
+def _calculate_withdrawal_fee(amount):
+    amount = round_decimal(amount)
+    fee = round_decimal(max(amount * _FEE_FRACTION, WITHDRAWAL_FEE_MIN))
+    # Both operands are already whole cents, so the difference needs no rounding
+    return fee, amount - fee
+
+# Round amounts cover nearly every request, so their fees are computed once
+_FEE_CACHE = {amt: _calculate_withdrawal_fee(Decimal(amt)) for amt in range(10, 10001, 10)}
+
 def calculate_withdrawal_fee(amount):
     """Calculate withdrawal fee with proper decimal precision"""
-    amount = round_decimal(amount)
-    fee_percent = amount * (WITHDRAWAL_FEE_PERCENT / Decimal("100"))
-    fee = max(fee_percent, WITHDRAWAL_FEE_MIN)
-    fee = round_decimal(fee)
-    final_amount = round_decimal(amount - fee)
-    return fee, final_amount
+    if amount == int(amount):
+        cached = _FEE_CACHE.get(int(amount))
+        if cached:
+            return cached
+    return _calculate_withdrawal_fee(amount)
+
+# Fee explanation on the withdraw screen; its inputs are all constants
+EXAMPLE_FEE, EXAMPLE_FINAL = calculate_withdrawal_fee(Decimal("100"))
+WITHDRAW_FEE_BLURB = (f"Fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})\n"
+                      f"Example: ₹100 → Fee ₹{float(EXAMPLE_FEE):.2f} → You get ₹{float(EXAMPLE_FINAL):.2f}")
 
 def can_submit_gmail(user_id):
     """Check cooldown for Gmail submission"""
     with get_db() as conn:
         c = conn.cursor()
         try:
-            c.execute("SELECT last_submit_time FROM users WHERE user_id=%s", (user_id,))
+            c.execute("EXECUTE p_user_meta(%s)", (user_id,))
         except psycopg2.Error:
             return True, 0
         
         result = c.fetchone()
         
-        if not result or not result['last_submit_time']:
+        if not result or result['since_last_submit'] is None:
             return True, 0
         
-        last_time = datetime.fromisoformat(result['last_submit_time'])
-        time_passed = (datetime.now() - last_time).total_seconds()
+        time_passed = float(result['since_last_submit'])
         
         if time_passed < SUBMIT_COOLDOWN:
             return False, int(SUBMIT_COOLDOWN - time_passed)
         return True, 0
 
-def update_submit_time(user_id):
-    """Update last submit time"""
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("UPDATE users SET last_submit_time=%s WHERE user_id=%s", 
-                 (datetime.now().isoformat(), user_id))
-
 def can_withdraw_today(user_id):
     """Check if user can withdraw today"""
-    with get_db() as conn:
-        c = conn.cursor()
-        today = datetime.now().date().isoformat()
-        c.execute("""SELECT COUNT(*) FROM withdrawals 
-                    WHERE user_id=%s AND request_date::date=%s AND status IN ('pending', 'approved')""",
-                 (user_id, today))
-        count = list(c.fetchone().values())[0]
-        return count < MAX_WITHDRAWALS_PER_DAY, MAX_WITHDRAWALS_PER_DAY - count
+    count = cache_get(_withdraw_today_cache, user_id)
+    if count is None:
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute("EXECUTE p_withdraw_today_count(%s)", (user_id,))
+            count = c.fetchone()['n']
+        cache_set(_withdraw_today_cache, user_id, count)
+    return count < MAX_WITHDRAWALS_PER_DAY, MAX_WITHDRAWALS_PER_DAY - count
 
 def check_duplicate_email(email):
-    """Check if email exists (normalized)"""
-    normalized = normalize_email(email)
+    """Look up an earlier submission of email, for an early duplicate notice"""
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT user_id, status FROM gmail WHERE LOWER(TRIM(email))=%s LIMIT 1", (normalized,))
+        c.execute("SELECT user_id, status FROM gmail WHERE email_key=%s LIMIT 1", (normalize_email(email),))
         result = c.fetchone()
         return result
 
-def log_audit(action, admin_id, target_user_id=None, details=""):
-    """Audit logging function"""
+def find_submitted_emails(keys):
+    """The subset of normalize_email() keys that were submitted before"""
+    with get_db() as conn:
+        c = conn.cursor(cursor_factory=TupleCursor)
+        c.execute("SELECT email_key FROM gmail WHERE email_key = ANY(%s)", (keys,))
+        return {key for (key,) in c.fetchall()}
+
+def log_audit(action, admin_id, target_user_id=None, details="", conn=None):
+    """Audit logging function. With conn, the entry joins the caller's transaction."""
+    sql = """INSERT INTO audit_log (action, admin_id, target_user_id, details, timestamp)
+             VALUES (%s, %s, %s, %s, NOW())"""
+    params = (action, admin_id, target_user_id, details)
+    if conn is not None:
+        conn.cursor(cursor_factory=TupleCursor).execute(sql, params)
+        return
     try:
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""INSERT INTO audit_log (action, admin_id, target_user_id, details, timestamp)
-                        VALUES (%s, %s, %s, %s, %s)""",
-                     (action, admin_id, target_user_id, details, datetime.now().isoformat()))
+            conn.cursor(cursor_factory=TupleCursor).execute(sql, params)
     except Exception as e:
         logger.error(f"Audit log error: {e}")
 
+# Admin actions queue their audit entries; audit_writer() inserts them in
+# batches so the callback never waits on the write
+AUDIT_BATCH_SIZE = 50
+AUDIT_FLUSH_INTERVAL = 0.2  # seconds
+_audit_queue = asyncio.Queue(maxsize=10_000)
+
+def queue_audit(action, admin_id, target_user_id=None, details=""):
+    """Queue an audit entry; writes it directly if the queue is full"""
+    entry = (action, admin_id, target_user_id, details, datetime.now().astimezone())
+    try:
+        _audit_queue.put_nowait(entry)
+    except asyncio.QueueFull:
+        spawn(db_run(log_audit, action, admin_id, target_user_id, details))
+
+def _write_audit_batch(rows):
+    try:
+        with get_db() as conn:
+            execute_values(conn.cursor(cursor_factory=TupleCursor),
+                           """INSERT INTO audit_log (action, admin_id, target_user_id, details, timestamp)
+                              VALUES %s""", rows)
+    except Exception as e:
+        logger.error(f"Audit log error ({len(rows)} entries): {e}")
+
+async def audit_writer():
+    """Drain _audit_queue in batches until a None sentinel arrives"""
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        entry = await _audit_queue.get()
+        if entry is None:
+            break
+        rows = [entry]
+        deadline = loop.time() + AUDIT_FLUSH_INTERVAL
+        while len(rows) < AUDIT_BATCH_SIZE:
+            try:
+                entry = await asyncio.wait_for(_audit_queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if entry is None:
+                running = False
+                break
+            rows.append(entry)
+        await db_run(_write_audit_batch, rows)
+
+# Fire-and-forget tasks are held here so they are not garbage collected mid-flight
+_background_tasks = set()
+
+def spawn(coro):
+    """Run coro concurrently with the caller without awaiting it"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def referral_link(bot, user_id):
+    """Deep link that registers user_id as the referrer on /start"""
+    global _ref_link_template
+    if _ref_link_template is None:
+        _ref_link_template = f"https://t.me/{bot.username}?start={{uid}}"
+    return _ref_link_template.format(uid=user_id)
+
+async def show_user_gmail_panel(update, context, uid, page, panel):
+    """Redraw the review panel after an action, or go back to the queue once it is empty"""
+    gmails, total_pending, user_info = panel
+    if user_info and gmails:
+        text, markup = render_user_gmail(uid, page, gmails, total_pending, user_info)
+        await safe_edit_or_reply(update.callback_query, text, markup)
+    else:
+        await cb_gmail_queue(update, context, update.callback_query, "gmail_queue_0")
+
 async def check_channel(user_id, context):
     """Check channel membership with error handling"""
+    if cache_get(_channel_member_cache, user_id):
+        return True
+    if cache_get(_channel_nonmember_cache, user_id):
+        return False
+    
     try:
-        channel = TELEGRAM_CHANNEL.lstrip('@')
-        if not channel.startswith('@'):
-            channel = '@' + channel
-        
-        member = await context.bot.get_chat_member(channel, user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        member = await context.bot.get_chat_member(_CHANNEL_CHAT, user_id)
+        is_member = member.status in ['member', 'administrator', 'creator']
+        cache_set(_channel_member_cache if is_member else _channel_nonmember_cache, user_id, True)
+        return is_member
     except Exception as e:
         logger.error(f"Channel check error for {user_id}: {e}")
         return False
@@ -398,36 +1177,25 @@ def calc_rate(user_id):
     1️⃣ Active time-limited offer from DB (highest priority)
     2️⃣ Weekly rolling tier (last 7 days) fallback
     """
+    cached = cache_get(_rate_cache, user_id)
+    if cached is not None:
+        return cached
+
+    rate = _calc_rate_uncached(user_id)
+    cache_set(_rate_cache, user_id, rate)
+    return rate
 
+def _calc_rate_uncached(user_id):
     with get_db() as conn:
         c = conn.cursor()
+        # 🔥 STEP 1: ACTIVE TIME-LIMITED OFFER, 🔁 STEP 2: WEEKLY ROLLING TIER
+        c.execute("EXECUTE p_rate(%s)", (user_id,))
+        result = c.fetchone()
 
-        # 🔥 STEP 1: CHECK ACTIVE TIME-LIMITED OFFER
-        c.execute("""
-            SELECT rate
-            FROM rate_rules
-            WHERE is_active = TRUE
-              AND start_time <= NOW()
-              AND end_time >= NOW()
-            ORDER BY rate DESC
-            LIMIT 1
-        """)
-        offer = c.fetchone()
-
-        if offer:
-            return Decimal(str(offer['rate']))
-
-        # 🔁 STEP 2: WEEKLY ROLLING LOGIC (YOUR ORIGINAL SYSTEM)
-        c.execute("""
-            SELECT COUNT(*) 
-            FROM gmail
-            WHERE user_id = %s
-              AND status = 'approved'
-              AND review_date::timestamptz >= NOW() - INTERVAL '7 days'
-        """, (user_id,))
-
-        approved_last_7_days = list(c.fetchone().values())[0]
+    if result['offer'] is not None:
+        return Decimal(str(result['offer']))
 
+    approved_last_7_days = result['n']
     if approved_last_7_days >= 200:
         return Decimal("30")
     elif approved_last_7_days >= 100:
@@ -435,9 +1203,9 @@ def calc_rate(user_id):
     else:
         return Decimal("20")
 
-def get_user_status_label(user_id):
+def get_user_status_label(weekly_approvals):
     """
-    Get user status label based on weekly activity
+    Get user status label from the approvals of the last 7 days
     
     Labels:
     - Beginner: 0-49 approvals
@@ -445,17 +1213,6 @@ def get_user_status_label(user_id):
     - Trusted: 100-199 approvals
     - Pro Contributor: 200+ approvals
     """
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT COUNT(*) FROM gmail
-            WHERE user_id = %s 
-            AND status = 'approved'
-            AND review_date::timestamptz >= NOW() - INTERVAL '7 days'
-        """, (user_id,))
-        
-        weekly_approvals = list(c.fetchone().values())[0]
-    
     if weekly_approvals >= 200:
         return "Pro Contributor"
     elif weekly_approvals >= 100:
@@ -465,21 +1222,10 @@ def get_user_status_label(user_id):
     else:
         return "Beginner"
 
-def get_weekly_progress_message(user_id):
+def get_weekly_progress_message(weekly_approvals):
     """
     Get progress message showing how close user is to next tier
     """
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("""
-            SELECT COUNT(*) FROM gmail
-            WHERE user_id = %s 
-            AND status = 'approved'
-            AND review_date::timestamptz >= NOW() - INTERVAL '7 days'
-        """, (user_id,))
-        
-        weekly_approvals = list(c.fetchone().values())[0]
-    
     if weekly_approvals >= 200:
         return f"Weekly progress: {weekly_approvals} approvals (Max tier achieved!)"
     elif weekly_approvals >= 100:
@@ -491,71 +1237,140 @@ def get_weekly_progress_message(user_id):
 
 def is_blocked(user_id):
     """Check if user is blocked"""
+    cached = cache_get(_blocked_cache, user_id)
+    if cached is not None:
+        return cached
+    
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT is_blocked FROM users WHERE user_id=%s", (user_id,))
+        c.execute("EXECUTE p_user_meta(%s)", (user_id,))
         result = c.fetchone()
-        return result['is_blocked'] == 1 if result else False
+        blocked = result['is_blocked'] == 1 if result else False
+    
+    cache_set(_blocked_cache, user_id, blocked)
+    return blocked
 
 def notifications_enabled(user_id):
     """Check if user has notifications enabled"""
+    cached = cache_get(_notif_cache, user_id)
+    if cached is not None:
+        return cached
+    
     try:
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT notifications_enabled FROM users WHERE user_id=%s", (user_id,))
+            c.execute("EXECUTE p_user_meta(%s)", (user_id,))
             result = c.fetchone()
-            return result['notifications_enabled'] == 1 if result else True
+            enabled = result['notifications_enabled'] == 1 if result else True
     except Exception as e:
         logger.error(f"notifications_enabled error: {e}")
         return True
+    
+    cache_set(_notif_cache, user_id, enabled)
+    return enabled
+
+def _set_bot_blocked(user_id):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET bot_blocked=1 WHERE user_id=%s", (user_id,))
+
+def mark_unreachable(user_id):
+    """Stop sending to a user who has blocked the bot"""
+    if user_id not in _unreachable_users:
+        _unreachable_users.add(user_id)
+        spawn(db_run(_set_bot_blocked, user_id))
+
+# Notifications are queued and sent by notify_worker() in concurrent batches,
+# so handlers that notify users never wait on the Telegram API
+NOTIFY_BATCH_SIZE = 30
+_notify_queue = asyncio.Queue(maxsize=10_000)
 
 async def notify_user(context, user_id, message):
+    """Queue a notification for user_id; sends it directly if the queue is full"""
+    if user_id in _unreachable_users:
+        return False
+    try:
+        _notify_queue.put_nowait((context.bot, user_id, message))
+    except asyncio.QueueFull:
+        spawn(deliver_notification(context.bot, user_id, message))
+    return True
+
+async def deliver_notification(bot, user_id, message):
     """Send notification to user with error handling"""
+    if user_id in _unreachable_users:
+        return False
     try:
-        if not notifications_enabled(user_id):
+        enabled = cache_get(_notif_cache, user_id)
+        if enabled is None:
+            enabled = await db_run(notifications_enabled, user_id)
+        if not enabled:
             logger.info(f"Notifications disabled for user {user_id}")
             return False
         
-        await context.bot.send_message(user_id, message, parse_mode=None)
+        async with _send_limiter:
+            await bot.send_message(user_id, message, parse_mode=None)
         logger.info(f"✅ Notification sent to user {user_id}")
         return True
         
+    except Forbidden:
+        mark_unreachable(user_id)
+        return False
     except Exception as e:
         logger.error(f"❌ Failed to notify user {user_id}: {e}")
         return False
 
+async def notify_worker():
+    """Drain _notify_queue in concurrent batches until a None sentinel arrives"""
+    running = True
+    while running:
+        item = await _notify_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        while len(batch) < NOTIFY_BATCH_SIZE and not _notify_queue.empty():
+            item = _notify_queue.get_nowait()
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+        await asyncio.gather(*(deliver_notification(*n) for n in batch), return_exceptions=True)
+
+async def reply_and_notify_admin(update, context, text, admin_text, reply_markup=None):
+    """Send the user's reply and the admin alert concurrently"""
+    reply, alert = await asyncio.gather(
+        update.message.reply_text(text, reply_markup=reply_markup, parse_mode=None),
+        context.bot.send_message(ADMIN_ID, admin_text, parse_mode=None),
+        return_exceptions=True
+    )
+    if isinstance(alert, Exception):
+        logger.error(f"Failed to notify admin: {alert}")
+    if isinstance(reply, Exception):
+        raise reply
+
+# Start of each earnings period, evaluated by the database clock
+EARNINGS_PERIOD_START = {
+    'today': "date_trunc('day', NOW())",
+    'week': "NOW() - INTERVAL '7 days'",
+    'month': "NOW() - INTERVAL '30 days'",
+}
+
 def get_earnings_stats(user_id, period='all'):
     """Get earnings statistics for different time periods"""
+    start = EARNINGS_PERIOD_START.get(period, "TIMESTAMPTZ '2000-01-01'")
     with get_db() as conn:
-        c = conn.cursor()
-        
-        now = datetime.now()
-        
-        if period == 'today':
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-        elif period == 'week':
-            start_date = (now - timedelta(days=7)).isoformat()
-        elif period == 'month':
-            start_date = (now - timedelta(days=30)).isoformat()
-        else:
-            start_date = '2000-01-01'
-        
-        c.execute("""SELECT COALESCE(SUM(reward), 0) FROM gmail 
-                    WHERE user_id=%s AND status='approved' AND review_date >= %s""",
-                 (user_id, start_date))
-        gmail_earnings = float(c.fetchone().values().__iter__().__next__())
+        c = conn.cursor(cursor_factory=TupleCursor)
         
-        c.execute("""SELECT COALESCE(SUM(reward), 0) FROM referrals 
-                    WHERE referrer_id=%s AND rewarded=1 AND date >= %s""",
-                 (user_id, start_date))
-        referral_earnings = float(c.fetchone().values().__iter__().__next__())
+        c.execute(f"""SELECT (SELECT COALESCE(SUM(reward), 0) FROM gmail
+                              WHERE user_id=%(uid)s AND status='approved' AND review_date >= {start}),
+                             (SELECT COALESCE(SUM(reward), 0) FROM referrals
+                              WHERE referrer_id=%(uid)s AND rewarded=1 AND date >= {start}),
+                             (SELECT channel_claimed FROM users WHERE user_id=%(uid)s)""",
+                 {'uid': user_id})
+        gmail_earnings, referral_earnings, channel_claimed = c.fetchone()
+        gmail_earnings, referral_earnings = float(gmail_earnings), float(referral_earnings)
         
-        if period == 'all':
-            c.execute("SELECT channel_claimed FROM users WHERE user_id=%s", (user_id,))
-            result = c.fetchone()
-            channel_bonus = 1 if result and result['channel_claimed'] else 0
-        else:
-            channel_bonus = 0
+        # The channel bonus has no date, so it only counts towards all-time
+        channel_bonus = 1 if period == 'all' and channel_claimed else 0
         
         return {
             'gmail': gmail_earnings,
@@ -572,7 +1387,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return
     
-    if is_blocked(user.id):
+    # A known block needs no query; otherwise the upsert below reports it
+    if cache_get(_blocked_cache, user.id):
         await message_to_use.reply_text("⛔ Your account has been blocked from using this service.")
         return
     
@@ -586,77 +1402,51 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
     
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users WHERE user_id=%s", (user.id,))
-        existing = c.fetchone()
-        
-        if not existing:
-            c.execute("""INSERT INTO users (user_id, username, first_name, referrer_id, joined_date)
-                         VALUES (%s, %s, %s, %s, %s)""",
-                      (user.id, user.username, user.first_name, ref_id, datetime.now().isoformat()))
-            
-            # Register referral but DON'T reward yet (rewarded after first approval)
-            if ref_id and ref_id != user.id:
-                c.execute("SELECT user_id FROM users WHERE user_id=%s", (ref_id,))
-                if c.fetchone():
-                    try:
-                        c.execute("INSERT INTO referrals (referrer_id, referred_id, reward, date, rewarded) VALUES (%s,%s,%s,%s,%s)",
-                                 (ref_id, user.id, 5, datetime.now().isoformat(), 0))
-                        await notify_user(context, ref_id, 
-                            f"New referral: {user.first_name}\n\n"
-                            f"You will earn ₹5 when they complete their first verified submission.")
-                    except psycopg2.IntegrityError:
-                        pass
-    
-    kb = [
-        [InlineKeyboardButton("📧 Submit Gmail", callback_data="submit")],
-        [InlineKeyboardButton("📦 Bulk Submit (2-20)", callback_data="bulk_submit")],
-        [InlineKeyboardButton("💰 Balance", callback_data="balance"),
-         InlineKeyboardButton("📋 History", callback_data="history")],
-        [InlineKeyboardButton("💸 Withdraw", callback_data="withdraw"),
-         InlineKeyboardButton("👤 Profile", callback_data="profile")],
-        [InlineKeyboardButton("👥 Refer & Earn", callback_data="referral")],
-        [InlineKeyboardButton("📊 Earnings", callback_data="earnings")],
-        [InlineKeyboardButton("⚙️ Settings", callback_data="settings"),
-         InlineKeyboardButton("❓ Help", callback_data="help")]
-    ]
-    
-    if user.id == ADMIN_ID:
-        kb.append([InlineKeyboardButton("⚙️ ADMIN", callback_data="admin")])
-    
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT channel_claimed FROM users WHERE user_id=%s", (user.id,))
-        result = c.fetchone()
-        claimed = result['channel_claimed'] if result else 0
-    
-    text = f"""Welcome {user.first_name}
-
-Earn money by submitting Gmail accounts.
-
-Rates per account (based on last 7 days):
-- 0-99 approvals: ₹20
-- 100-199 approvals: ₹25
-- 200+ approvals: ₹30
-
-Bonus earnings:
-- Join channel: ₹1 (one-time)
-- Refer friends: ₹5 per person
-
-Withdrawal fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
-
-Note: Your rate updates automatically based on weekly activity. Stay active to maintain higher tiers!
+    def register_user():
+        """Upsert the user; returns (blocked, channel_claimed, referral_recorded)"""
+        with get_db() as conn:
+            c = conn.cursor(cursor_factory=TupleCursor)
+            # xmax is 0 only on a freshly inserted row. The referral is registered
+            # in the same statement but DON'T reward yet (rewarded after first approval)
+            c.execute("""WITH u AS (
+                             INSERT INTO users (user_id, username, first_name, referrer_id, joined_date)
+                             VALUES (%(uid)s, %(username)s, %(first_name)s, %(ref)s, NOW())
+                             ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, bot_blocked = 0
+                             RETURNING is_blocked, channel_claimed, (xmax = 0) AS inserted
+                         ), r AS (
+                             INSERT INTO referrals (referrer_id, referred_id, reward, date, rewarded)
+                             SELECT %(ref)s, %(uid)s, 5, NOW(), 0 FROM u
+                             WHERE u.inserted
+                               AND EXISTS (SELECT 1 FROM users WHERE user_id = %(ref)s)
+                             ON CONFLICT (referred_id) DO NOTHING
+                             RETURNING id
+                         )
+                         SELECT u.is_blocked = 1, u.channel_claimed, EXISTS (SELECT 1 FROM r) FROM u""",
+                      {'uid': user.id, 'username': user.username,
+                       'first_name': user.first_name, 'ref': ref_id})
+            return c.fetchone()
+
+    blocked, claimed, referred = await db_run(register_user)
+    _unreachable_users.discard(user.id)
+    cache_set(_blocked_cache, user.id, blocked)
+    if blocked:
+        await message_to_use.reply_text("⛔ Your account has been blocked from using this service.")
+        return
+    if claimed:
+        _channel_claimed_users.add(user.id)
+    if referred:
+        await notify_user(context, ref_id,
+            f"New referral: {user.first_name}\n\n"
+            f"You will earn ₹5 when they complete their first verified submission.")
 
-Join our channel: {TELEGRAM_CHANNEL}"""
+    if user.id == ADMIN_ID:
+        markup = MAIN_MENU_MARKUP_ADMIN if claimed else MAIN_MENU_MARKUP_ADMIN_UNCLAIMED
+    else:
+        markup = MAIN_MENU_MARKUP if claimed else MAIN_MENU_MARKUP_UNCLAIMED
     
-    if not claimed:
-        text += "\n\n⚡ Join channel to claim ₹1 bonus"
-        channel_url = f"https://t.me/{TELEGRAM_CHANNEL.lstrip('@')}"
-        kb.insert(0, [InlineKeyboardButton("📢 Join Channel", url=channel_url)])
-        kb.insert(1, [InlineKeyboardButton("🎁 Claim ₹1", callback_data="claim_channel")])
+    text = (WELCOME_TPL if claimed else WELCOME_UNCLAIMED_TPL).format(name=user.first_name)
     
-    await message_to_use.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+    await message_to_use.reply_text(text, reply_markup=markup, parse_mode=None)
 async def safe_edit_or_reply(q, text, reply_markup=None):
     """
     Safely edits a message if possible, otherwise sends a new reply.
@@ -682,155 +1472,132 @@ async def safe_edit_or_reply(q, text, reply_markup=None):
             parse_mode=None
         )
 
-async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    
-    if is_blocked(q.from_user.id) and q.from_user.id != ADMIN_ID:
-        await q.answer("Your account is blocked", show_alert=True)
-        return
+# CHANNEL CLAIM - IDEMPOTENT
+async def cb_claim_channel(update, context, q, d):
+    await q.answer("Checking membership...", show_alert=False)
     
-    d = q.data
-    
-    # CHANNEL CLAIM - IDEMPOTENT
-    if d == "claim_channel":
-        await q.answer("Checking membership...", show_alert=False)
-        
-        if await check_channel(q.from_user.id, context):
+    if q.from_user.id in _channel_claimed_users:
+        await q.answer("You have already claimed this bonus", show_alert=True)
+    elif await check_channel(q.from_user.id, context):
+        def claim_bonus():
             with get_db() as conn:
                 c = conn.cursor()
                 # ATOMIC UPDATE - Only claim if not already claimed
                 c.execute("""
-                    UPDATE users 
-                    SET balance=balance+1, channel_claimed=1 
-                    WHERE user_id=%s AND channel_claimed=0
-                    RETURNING user_id
-                """, (q.from_user.id,))
-                
-                result = c.fetchone()
-                
-                if result:
-                    conn.commit()
-                    await q.answer("₹1 added to your balance", show_alert=True)
-                    await q.message.reply_text("Bonus credited: ₹1\n\nThank you for joining our channel.")
-                else:
-                    await q.answer("You have already claimed this bonus", show_alert=True)
+                        WITH upd AS (
+                            UPDATE users 
+                            SET balance=balance+1, channel_claimed=1 
+                            WHERE user_id=%s AND channel_claimed=0
+                            RETURNING 1
+                        )
+                        SELECT EXISTS (SELECT 1 FROM upd) AS claimed
+                    """, (q.from_user.id,))
+                return c.fetchone()['claimed']
+
+        claimed = await db_run(claim_bonus)
+        _channel_claimed_users.add(q.from_user.id)
+        
+        if claimed:
+            await q.answer("₹1 added to your balance", show_alert=True)
+            await q.message.reply_text("Bonus credited: ₹1\n\nThank you for joining our channel.")
         else:
-            await q.answer(f"Please join {TELEGRAM_CHANNEL} first", show_alert=True)
-        return
-    
-    # MENU
-    if d == "menu":
-        kb = [
-            [InlineKeyboardButton("📧 Submit", callback_data="submit")],
-            [InlineKeyboardButton("📦 Bulk Submit (2-20)", callback_data="bulk_submit")],
-            [InlineKeyboardButton("💰 Balance", callback_data="balance"),
-             InlineKeyboardButton("📋 History", callback_data="history")],
-            [InlineKeyboardButton("💸 Withdraw", callback_data="withdraw"),
-             InlineKeyboardButton("👤 Profile", callback_data="profile")],
-            [InlineKeyboardButton("👥 Refer & Earn", callback_data="referral")],
-            [InlineKeyboardButton("📊 Earnings", callback_data="earnings")],
-            [InlineKeyboardButton("⚙️ Settings", callback_data="settings"),
-             InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        if q.from_user.id == ADMIN_ID:
-            kb.append([InlineKeyboardButton("⚙️ ADMIN", callback_data="admin")])
-        await q.edit_message_text("Main Menu", reply_markup=InlineKeyboardMarkup(kb))
-        return ConversationHandler.END
+            await q.answer("You have already claimed this bonus", show_alert=True)
+    else:
+        await q.answer(f"Please join {TELEGRAM_CHANNEL} first", show_alert=True)
+
+# MENU
+async def cb_menu(update, context, q, d):
+    markup = MAIN_MENU_MARKUP_ADMIN if q.from_user.id == ADMIN_ID else MAIN_MENU_MARKUP
+    await q.edit_message_text("Main Menu", reply_markup=markup)
+    return ConversationHandler.END
+
+# SUBMIT GMAIL - WITH COOLDOWN
+async def cb_submit(update, context, q, d):
+    can_submit, wait_time = await db_run(can_submit_gmail, q.from_user.id)
     
-    # SUBMIT GMAIL - WITH COOLDOWN
-    elif d == "submit":
-        can_submit, wait_time = can_submit_gmail(q.from_user.id)
-        
-        if not can_submit:
-            await q.answer(f"Please wait {wait_time} seconds", show_alert=True)
-            
-            temp_msg = await q.message.reply_text(
-                f"Cooldown active\n\n"
-                f"Please wait {wait_time} seconds before submitting again.\n\n"
-                f"This helps us process submissions efficiently.",
-                parse_mode=None
-            )
-            
-            await asyncio.sleep(5)
-            try:
-                await temp_msg.delete()
-            except:
-                pass
-            
-            return
+    if not can_submit:
+        await q.answer(f"Please wait {wait_time} seconds", show_alert=True)
         
-        await q.edit_message_text(
-            f"Submit Gmail Account\n\n"
-            f"Send the email address\n\n"
-            f"Allowed: {', '.join(ALLOWED_DOMAINS)}\n"
-            f"Only submit your own accounts\n\n"
-            f"/cancel to abort",
+        temp_msg = await q.message.reply_text(
+            f"Cooldown active\n\n"
+            f"Please wait {wait_time} seconds before submitting again.\n\n"
+            f"This helps us process submissions efficiently.",
             parse_mode=None
         )
-        return EMAIL
-    
-    # BULK SUBMIT GMAIL
-    elif d == "bulk_submit":
-        can_submit, wait_time = can_submit_gmail(q.from_user.id)
         
-        if not can_submit:
-            await q.answer(f"Please wait {wait_time} seconds", show_alert=True)
-            
-            temp_msg = await q.message.reply_text(
-                f"Cooldown active\n\n"
-                f"Please wait {wait_time} seconds before submitting.\n\n"
-                f"This helps us process submissions efficiently.",
-                parse_mode=None
-            )
-            
-            await asyncio.sleep(5)
-            try:
-                await temp_msg.delete()
-            except:
-                pass
-            
-            return
+        await asyncio.sleep(5)
+        try:
+            await temp_msg.delete()
+        except:
+            pass
         
-        await q.edit_message_text(
-            "Bulk Gmail Submission\n\n"
-            "Submit 2-20 Gmail accounts at once\n\n"
-            "Format (one per line):\n"
-            "email@gmail.com | password123\n"
-            "email2@gmail.com | pass456\n\n"
-            "Use | (pipe) to separate email and password\n\n"
-            "/cancel to abort",
+        return
+    
+    await q.edit_message_text(
+        f"Submit Gmail Account\n\n"
+        f"Send the email address\n\n"
+        f"Allowed: {', '.join(ALLOWED_DOMAINS)}\n"
+        f"Only submit your own accounts\n\n"
+        f"/cancel to abort",
+        parse_mode=None
+    )
+    return EMAIL
+
+# BULK SUBMIT GMAIL
+async def cb_bulk_submit(update, context, q, d):
+    can_submit, wait_time = await db_run(can_submit_gmail, q.from_user.id)
+    
+    if not can_submit:
+        await q.answer(f"Please wait {wait_time} seconds", show_alert=True)
+        
+        temp_msg = await q.message.reply_text(
+            f"Cooldown active\n\n"
+            f"Please wait {wait_time} seconds before submitting.\n\n"
+            f"This helps us process submissions efficiently.",
             parse_mode=None
         )
-        return BULK_GMAIL
+        
+        await asyncio.sleep(5)
+        try:
+            await temp_msg.delete()
+        except:
+            pass
+        
+        return
     
-    # BALANCE
-    elif d == "balance":
+    await q.edit_message_text(
+        "Bulk Gmail Submission\n\n"
+        "Submit 2-20 Gmail accounts at once\n\n"
+        "Format (one per line):\n"
+        "email@gmail.com | password123\n"
+        "email2@gmail.com | pass456\n\n"
+        "Use | (pipe) to separate email and password\n\n"
+        "/cancel to abort",
+        parse_mode=None
+    )
+    return BULK_GMAIL
+
+# BALANCE
+async def cb_balance(update, context, q, d):
+    def fetch_balance():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT balance, total_gmail, approved_gmail FROM users WHERE user_id=%s", 
-                     (q.from_user.id,))
-            result = c.fetchone()
-            
-            c.execute("SELECT COALESCE(SUM(reward), 0) FROM gmail WHERE user_id=%s AND status='pending'", 
-                     (q.from_user.id,))
-            pending = float(c.fetchone().values().__iter__().__next__() or 0)
-            
-            # Get weekly stats
-            c.execute("""
-                SELECT COUNT(*) FROM gmail
-                WHERE user_id = %s 
-                AND status = 'approved'
-                AND review_date::timestamptz >= NOW() - INTERVAL '7 days'
-            """, (q.from_user.id,))
-            weekly_approvals = list(c.fetchone().values())[0]
-        
-        bal, total, approved = (float(result['balance']), result['total_gmail'], result['approved_gmail']) if result else (0,0,0)
-        rate = float(calc_rate(q.from_user.id))
-        status_label = get_user_status_label(q.from_user.id)
-        progress_msg = get_weekly_progress_message(q.from_user.id)
-        
-        text = f"""Balance: ₹{bal:.2f}
+            # User row, pending sum and weekly stats in one round-trip
+            c.execute("EXECUTE p_balance_panel(%s)", (q.from_user.id,))
+            return c.fetchone()
+
+    result = await db_run(fetch_balance)
+    
+    if result:
+        bal, total, approved = float(result['balance']), result['total_gmail'], result['approved_gmail']
+        pending, weekly_approvals = float(result['pending']), result['weekly_approvals']
+    else:
+        bal, total, approved, pending, weekly_approvals = 0, 0, 0, 0.0, 0
+    rate = float(await db_run(calc_rate, q.from_user.id))
+    status_label = get_user_status_label(weekly_approvals)
+    progress_msg = get_weekly_progress_message(weekly_approvals)
+    
+    text = f"""Balance: ₹{bal:.2f}
 
 Status: {status_label}
 Current rate: ₹{rate} per account
@@ -844,25 +1611,23 @@ Total submitted: {total}
 This week: {weekly_approvals} approvals
 
 Note: Rates are based on your last 7 days of activity"""
-        
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]), parse_mode=None)
+    
+    await q.edit_message_text(text, reply_markup=BACK_TO_MENU_MARKUP, parse_mode=None)
 
-# EARNINGS DASHBOARD (continuation of callback function)
-    elif d == "earnings" or d.startswith("earnings_"):
-        period = d.split("_")[1] if "_" in d else "all"
-        
-        stats = get_earnings_stats(q.from_user.id, period)
-        
-        period_names = {
-            'today': 'Today',
-            'week': 'This Week',
-            'month': 'This Month',
-            'all': 'All Time'
-        }
-        
-        text = f"""Earnings Dashboard
+# EARNINGS DASHBOARD
+async def cb_earnings(update, context, q, d):
+    period = d.split("_")[1] if "_" in d else "all"
+    
+    stats = await db_run(get_earnings_stats, q.from_user.id, period)
+    
+    period_names = {
+        'today': 'Today',
+        'week': 'This Week',
+        'month': 'This Month',
+        'all': 'All Time'
+    }
+    
+    text = f"""Earnings Dashboard
 
 Period: {period_names.get(period, 'All Time')}
 
@@ -871,34 +1636,27 @@ Referrals: ₹{stats['referral']:.2f}
 Channel bonus: ₹{stats['channel']:.2f}
 
 Total: ₹{stats['total']:.2f}"""
-        
-        kb = [
-            [InlineKeyboardButton("📅 Today", callback_data="earnings_today"),
-             InlineKeyboardButton("📅 Week", callback_data="earnings_week")],
-            [InlineKeyboardButton("📅 Month", callback_data="earnings_month"),
-             InlineKeyboardButton("📅 All Time", callback_data="earnings_all")],
-            [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]
-        
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
     
-    # REFERRAL
-    elif d == "referral":
+    await q.edit_message_text(text, reply_markup=EARNINGS_MARKUP, parse_mode=None)
+
+# REFERRAL
+async def cb_referral(update, context, q, d):
+    def fetch_referral_stats():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id=%s", (q.from_user.id,))
-            ref_count = list(c.fetchone().values())[0]
-            
-            c.execute("SELECT COALESCE(SUM(reward), 0) FROM referrals WHERE referrer_id=%s AND rewarded=1", (q.from_user.id,))
-            total_earned = float(c.fetchone().values().__iter__().__next__() or 0)
-            
-            c.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id=%s AND rewarded=0", (q.from_user.id,))
-            pending_refs = c.fetchone().values().__iter__().__next__()
-        
-        bot_user = context.bot.username
-        ref_link = f"https://t.me/{bot_user}?start={q.from_user.id}"
-        
-        text = f"""Refer & Earn
+            c.execute("""SELECT COUNT(*) AS ref_count,
+                                    COALESCE(SUM(reward) FILTER (WHERE rewarded=1), 0) AS total_earned,
+                                    COUNT(*) FILTER (WHERE rewarded=0) AS pending_refs
+                             FROM referrals WHERE referrer_id=%s""", (q.from_user.id,))
+            return c.fetchone()
+
+    result = await db_run(fetch_referral_stats)
+    ref_count, pending_refs = result['ref_count'], result['pending_refs']
+    total_earned = float(result['total_earned'])
+    
+    ref_link = referral_link(context.bot, q.from_user.id)
+    
+    text = f"""Refer & Earn
 
 Earn ₹5 for each friend you refer
 Reward is credited after their first verified submission
@@ -912,888 +1670,755 @@ Your referral link:
 {ref_link}
 
 Share this link with friends to start earning."""
-        
-        kb = [
-            [InlineKeyboardButton("🏆 Leaderboard", callback_data="referral_leaderboard")],
-            [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
     
-    # REFERRAL LEADERBOARD
-    elif d == "referral_leaderboard":
+    await q.edit_message_text(text, reply_markup=REFERRAL_MARKUP, parse_mode=None)
+
+# REFERRAL LEADERBOARD
+async def cb_referral_leaderboard(update, context, q, d):
+    def fetch_leaderboard():
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT u.first_name, u.username, u.user_id, COUNT(r.id) as ref_count
-                        FROM users u
-                        JOIN referrals r ON u.user_id = r.referrer_id
-                        WHERE r.rewarded = 1
-                        GROUP BY u.user_id, u.first_name, u.username
-                        ORDER BY ref_count DESC
-                        LIMIT 10""")
-            top_referrers = c.fetchall()
-            
-            c.execute("""SELECT COUNT(DISTINCT referrer_id) + 1 as rank
-                        FROM referrals
-                        WHERE rewarded = 1 AND referrer_id IN (
-                            SELECT referrer_id FROM referrals
-                            WHERE rewarded = 1
-                            GROUP BY referrer_id
-                            HAVING COUNT(*) > (
-                                SELECT COUNT(*) FROM referrals WHERE referrer_id=%s AND rewarded=1
+            c = conn.cursor(cursor_factory=TupleCursor)
+            # Top 10 plus the caller's own row, ranked in a single pass
+            c.execute("""WITH ranked AS (
+                                SELECT u.user_id, u.first_name, COUNT(*) AS ref_count,
+                                       RANK() OVER (ORDER BY COUNT(*) DESC) AS rnk,
+                                       ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) AS pos
+                                FROM referrals r
+                                JOIN users u ON u.user_id = r.referrer_id
+                                WHERE r.rewarded = 1
+                                GROUP BY u.user_id, u.first_name
                             )
-                        )""", (q.from_user.id,))
-            result = c.fetchone()
-            user_rank = result[0] if result else "N/A"
-            
-            c.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id=%s AND rewarded=1", (q.from_user.id,))
-            user_refs = c.fetchone().values().__iter__().__next__()
-        
-        text = "Referral Leaderboard\n\n"
-        
-        if top_referrers:
-            medals = ["🥇", "🥈", "🥉"]
-            for idx, row in enumerate(top_referrers, 1):
-                medal = medals[idx-1] if idx <= 3 else f"{idx}."
-                name = row['first_name']
-                refs = row['ref_count']
-                text += f"{medal} {name} - {refs} referrals\n"
-        else:
-            text += "No referrals yet\n"
-        
-        text += f"\nYour rank: #{user_rank}\n"
-        text += f"Your referrals: {user_refs}"
-        
-        kb = [
-            [InlineKeyboardButton("🔙 Back", callback_data="referral")]
-        ]
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+                            SELECT user_id, first_name, ref_count, rnk, pos
+                            FROM ranked
+                            WHERE pos <= 10 OR user_id = %s
+                            ORDER BY pos""", (q.from_user.id,))
+            rows = c.fetchall()
+        
+        # Rows are (user_id, first_name, ref_count, rank, position)
+        top_referrers = [(name, refs) for _, name, refs, _, pos in rows if pos <= 10]
+        own = next((row for row in rows if row[0] == q.from_user.id), None)
+        user_rank = own[3] if own else "N/A"
+        user_refs = own[2] if own else 0
+        return top_referrers, user_rank, user_refs
+
+    top_referrers, user_rank, user_refs = await db_run(fetch_leaderboard)
+    
+    parts = ["Referral Leaderboard\n\n"]
+    
+    if top_referrers:
+        medals = ["🥇", "🥈", "🥉"]
+        for idx, (name, refs) in enumerate(top_referrers, 1):
+            medal = medals[idx-1] if idx <= 3 else f"{idx}."
+            parts.append(f"{medal} {name} - {refs} referrals\n")
+    else:
+        parts.append("No referrals yet\n")
+    
+    parts.append(f"\nYour rank: #{user_rank}\nYour referrals: {user_refs}")
+    text = "".join(parts)
+    
+    await q.edit_message_text(text, reply_markup=BACK_TO_REFERRAL_MARKUP, parse_mode=None)
 
-    # HISTORY - Gmail submissions
-    elif d == "history" or d.startswith("history_gmail_"):
-        page = validate_page(d.split("_")[-1]) if "_" in d else 0
-        offset = page * 5
-        
+# HISTORY - Gmail submissions
+async def cb_history_gmail(update, context, q, d):
+    page, direction, anchor = parse_history_cursor(d)
+    
+    def fetch_history():
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT email, status, reward, submit_date, rejection_reason 
-                        FROM gmail WHERE user_id=%s ORDER BY submit_date DESC 
-                        LIMIT 5 OFFSET %s""", (q.from_user.id, offset))
-            subs = c.fetchall()
-            
-            c.execute("SELECT COUNT(*) FROM gmail WHERE user_id=%s", (q.from_user.id,))
-            total = c.fetchone().values().__iter__().__next__()
-        
-        text = f"Gmail History (Page {page+1})\n\n"
-        if subs:
-            for sub in subs:
-                emoji = {"pending": "⏳", "approved": "✅", "rejected": "❌"}[sub['status']]
-                reward_val = float(sub['reward']) if sub['reward'] else 0
-                text += f"{emoji} {mask_email(sub['email'])}\n   {sub['status'].title()} - ₹{reward_val}"
-                if sub['rejection_reason']:
-                    text += f"\n   Reason: {sub['rejection_reason']}"
-                text += "\n\n"
-        else:
-            text += "No submissions yet"
-        
-        kb = []
-        nav = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"history_gmail_{page-1}"))
-        if offset + 5 < total:
-            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"history_gmail_{page+1}"))
-        if nav:
-            kb.append(nav)
-        
-        kb.append([InlineKeyboardButton("💸 Withdrawal History", callback_data="history_withdrawal_0")])
-        kb.append([InlineKeyboardButton("🔙 Back", callback_data="menu")])
-        
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+            return fetch_history_page(conn.cursor(cursor_factory=TupleCursor), "gmail",
+                                      "email, status, reward::float8, rejection_reason",
+                                      "submit_date", q.from_user.id, direction, anchor)
+
+    subs, has_prev, has_next = await db_run(fetch_history)
+    if not has_prev:
+        page = 0
+    
+    parts = [f"Gmail History (Page {page+1})\n\n"]
+    if subs:
+        for _, email, status, reward, rejection_reason in subs:
+            emoji, title = STATUS_LABELS[status]
+            parts.append(f"{emoji} {mask_email(email)}\n   {title} - ₹{reward or 0}")
+            if rejection_reason:
+                parts.append(f"\n   Reason: {rejection_reason}")
+            parts.append("\n\n")
+    else:
+        parts.append("No submissions yet")
+    text = "".join(parts)
     
-    # WITHDRAWAL HISTORY
-    elif d.startswith("history_withdrawal_"):
-        page = validate_page(d.split("_")[-1])
-        offset = page * 5
-        
+    kb = []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"history_gmail_{page-1}_b{subs[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"history_gmail_{page+1}_a{subs[-1][0]}"))
+    if nav:
+        kb.append(nav)
+    
+    kb.append(WITHDRAWAL_HISTORY_ROW)
+    kb.append(BACK_TO_MENU_ROW)
+    
+    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+
+# WITHDRAWAL HISTORY
+async def cb_history_withdrawal(update, context, q, d):
+    page, direction, anchor = parse_history_cursor(d)
+    
+    def fetch_withdrawal_history():
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT amount, fee, final_amount, method, status, request_date, processed_date, rejection_reason 
-                        FROM withdrawals WHERE user_id=%s ORDER BY request_date DESC 
-                        LIMIT 5 OFFSET %s""", (q.from_user.id, offset))
-            withdrawals = c.fetchall()
+            return fetch_history_page(conn.cursor(), "withdrawals",
+                                      # Amounts arrive as floats, with the display fallbacks applied
+                                      "amount::float8 AS amount, COALESCE(fee, 0)::float8 AS fee, "
+                                      "COALESCE(final_amount, amount)::float8 AS final_amount, "
+                                      "method, status, request_date, processed_date, rejection_reason",
+                                      "request_date", q.from_user.id, direction, anchor)
+
+    withdrawals, has_prev, has_next = await db_run(fetch_withdrawal_history)
+    if not has_prev:
+        page = 0
+    
+    parts = [f"Withdrawal History (Page {page+1})\n\n"]
+    if withdrawals:
+        for w in withdrawals:
+            emoji, title = STATUS_LABELS[w['status']]
+            method_emoji = "📱" if w['method'] == 'upi' else "💎"
             
-            c.execute("SELECT COUNT(*) FROM withdrawals WHERE user_id=%s", (q.from_user.id,))
-            total = c.fetchone().values().__iter__().__next__()
-        
-        text = f"Withdrawal History (Page {page+1})\n\n"
-        if withdrawals:
-            for w in withdrawals:
-                emoji = {"pending": "⏳", "approved": "✅", "rejected": "❌"}[w['status']]
-                method_emoji = "📱" if w['method'] == 'upi' else "💎"
-                
-                fee = float(w['fee']) if w['fee'] is not None else 0
-                final_amount = float(w['final_amount']) if w['final_amount'] is not None else float(w['amount'])
-                
-                text += f"{emoji} {method_emoji} ₹{float(w['amount']):.2f}\n"
-                text += f"   Fee: ₹{fee:.2f} | Final: ₹{final_amount:.2f}\n"
-                text += f"   {w['status'].title()} - {w['request_date'][:10]}\n"
-                if w['rejection_reason']:
-                    text += f"   Reason: {w['rejection_reason']}\n"
-                text += "\n"
-        else:
-            text += "No withdrawals yet"
-        
-        kb = []
-        nav = []
-        if page > 0:
-            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"history_withdrawal_{page-1}"))
-        if offset + 5 < total:
-            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"history_withdrawal_{page+1}"))
-        if nav:
-            kb.append(nav)
-        
-        kb.append([InlineKeyboardButton("📧 Gmail History", callback_data="history_gmail_0")])
-        kb.append([InlineKeyboardButton("🔙 Back", callback_data="menu")])
-        
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+            parts.append(f"{emoji} {method_emoji} ₹{w['amount']:.2f}\n"
+                         f"   Fee: ₹{w['fee']:.2f} | Final: ₹{w['final_amount']:.2f}\n"
+                         f"   {title} - {w['request_date']:%Y-%m-%d}\n")
+            if w['rejection_reason']:
+                parts.append(f"   Reason: {w['rejection_reason']}\n")
+            parts.append("\n")
+    else:
+        parts.append("No withdrawals yet")
+    text = "".join(parts)
+    
+    kb = []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"history_withdrawal_{page-1}_b{withdrawals[0]['id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"history_withdrawal_{page+1}_a{withdrawals[-1]['id']}"))
+    if nav:
+        kb.append(nav)
+    
+    kb.append(GMAIL_HISTORY_ROW)
+    kb.append(BACK_TO_MENU_ROW)
+    
+    await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
 
 # WITHDRAW - ATOMIC BALANCE CHECK
-    elif d == "withdraw":
+async def cb_withdraw(update, context, q, d):
+    def fetch_withdraw_info():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT balance, usdt_address, upi_id FROM users WHERE user_id=%s", 
-                     (q.from_user.id,))
-            result = c.fetchone()
-            
-            c.execute("SELECT COUNT(*) FROM withdrawals WHERE user_id=%s AND status='pending'", 
-                     (q.from_user.id,))
-            pending_count = list(c.fetchone().values())[0]
-        
-        can_withdraw, remaining = can_withdraw_today(q.from_user.id)
+            c.execute("EXECUTE p_withdraw_panel(%s)", (q.from_user.id,))
+            return c.fetchone()
+
+    result = await db_run(fetch_withdraw_info)
+    
+    if result:
+        bal, usdt, upi = float(result['balance']), result['usdt_address'], result['upi_id']
+        context.user_data['withdraw_payment'] = {'upi': upi, 'usdt': usdt}
+        pending_count = result['pending_count']
+        remaining = MAX_WITHDRAWALS_PER_DAY - result['today_count']
+        can_withdraw = remaining > 0
         
-        if result:
-            bal, usdt, upi = float(result['balance']), result['usdt_address'], result['upi_id']
-            
-            if not can_withdraw:
-                text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nDaily withdrawal limit reached\nYou can make {MAX_WITHDRAWALS_PER_DAY} withdrawals per day\n\nTry again tomorrow"
-                kb = [[InlineKeyboardButton("🔙 Back", callback_data="menu")]]
-            elif pending_count >= MAX_PENDING_WITHDRAWALS:
-                text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nYou have {pending_count} pending requests\nPlease wait for processing"
-                kb = [[InlineKeyboardButton("🔙 Back", callback_data="menu")]]
-            elif bal < 100:
-                text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nMinimum withdrawal amount: ₹100"
-                kb = [[InlineKeyboardButton("🔙 Back", callback_data="menu")]]
-            else:
-                example_fee, example_final = calculate_withdrawal_fee(Decimal("100"))
-                text = f"Withdraw\n\nBalance: ₹{bal:.2f}\nMinimum: ₹100\nToday: {remaining}/{MAX_WITHDRAWALS_PER_DAY} left\n\nFee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})\nExample: ₹100 → Fee ₹{float(example_fee):.2f} → You get ₹{float(example_final):.2f}\n\nChoose withdrawal method:"
-                kb = [
-                    [InlineKeyboardButton("📱 UPI" + (" ✅" if upi else ""), callback_data="withdraw_upi")],
-                    [InlineKeyboardButton("💎 USDT" + (" ✅" if usdt else ""), callback_data="withdraw_usdt")],
-                    [InlineKeyboardButton("⚙️ Setup Payment", callback_data="setup_payment")],
-                    [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-                ]
-            await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+        if not can_withdraw:
+            text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nDaily withdrawal limit reached\nYou can make {MAX_WITHDRAWALS_PER_DAY} withdrawals per day\n\nTry again tomorrow"
+            markup = BACK_TO_MENU_MARKUP
+        elif pending_count >= MAX_PENDING_WITHDRAWALS:
+            text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nYou have {pending_count} pending requests\nPlease wait for processing"
+            markup = BACK_TO_MENU_MARKUP
+        elif bal < 100:
+            text = f"Withdraw\n\nBalance: ₹{bal:.2f}\n\nMinimum withdrawal amount: ₹100"
+            markup = BACK_TO_MENU_MARKUP
         else:
-            await q.edit_message_text("Error occurred", 
-                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="menu")]]))
+            text = f"Withdraw\n\nBalance: ₹{bal:.2f}\nMinimum: ₹100\nToday: {remaining}/{MAX_WITHDRAWALS_PER_DAY} left\n\n{WITHDRAW_FEE_BLURB}\n\nChoose withdrawal method:"
+            markup = WITHDRAW_MARKUPS[bool(upi), bool(usdt)]
+        await q.edit_message_text(text, reply_markup=markup, parse_mode=None)
+    else:
+        await q.edit_message_text("Error occurred", 
+                                 reply_markup=BACK_TO_MENU_MARKUP)
+
+# WITHDRAW METHOD
+WITHDRAW_METHODS = {
+    'upi': ('upi_id', "Please setup UPI first", "Withdraw via UPI"),
+    'usdt': ('usdt_address', "Please setup USDT address first", "Withdraw via USDT"),
+}
+
+async def _withdraw_method(q, context, method):
+    column, missing_text, title = WITHDRAW_METHODS[method]
+    payment = context.user_data.get('withdraw_payment')
+    if payment is None:
+        # Button from an older menu (or after a restart): fall back to the DB
+        def fetch_payment():
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute("SELECT upi_id, usdt_address FROM users WHERE user_id=%s", (q.from_user.id,))
+                return c.fetchone()
+
+        result = await db_run(fetch_payment)
+        payment = {'upi': result['upi_id'], 'usdt': result['usdt_address']} if result else {}
+        context.user_data['withdraw_payment'] = payment
     
-    # WITHDRAW UPI
-    elif d == "withdraw_upi":
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("SELECT upi_id FROM users WHERE user_id=%s", (q.from_user.id,))
-            result = c.fetchone()
-        
-        if not result or not result['upi_id']:
-            await q.answer("Please setup UPI first", show_alert=True)
-            return
-        
-        context.user_data['withdraw_method'] = 'upi'
-        await q.edit_message_text(
-            "Withdraw via UPI\n\nEnter amount (Minimum: ₹100)\n\n/cancel to abort",
-            parse_mode=None
-        )
-        return WITHDRAW_AMT
+    if not payment.get(method):
+        await q.answer(missing_text, show_alert=True)
+        return
     
-    # WITHDRAW USDT
-    elif d == "withdraw_usdt":
+    context.user_data['withdraw_method'] = method
+    await q.edit_message_text(
+        f"{title}\n\nEnter amount (Minimum: ₹100)\n\n/cancel to abort",
+        parse_mode=None
+    )
+    return WITHDRAW_AMT
+
+async def cb_withdraw_upi(update, context, q, d):
+    return await _withdraw_method(q, context, 'upi')
+
+async def cb_withdraw_usdt(update, context, q, d):
+    return await _withdraw_method(q, context, 'usdt')
+
+# SETUP PAYMENT
+async def cb_setup_payment(update, context, q, d):
+    await q.edit_message_text("Setup Payment Method\n\nChoose:", 
+                              reply_markup=SETUP_PAYMENT_MARKUP, parse_mode=None)
+
+async def cb_set_upi(update, context, q, d):
+    await q.edit_message_text("Setup UPI\n\nSend your UPI ID\n/cancel to abort", 
+                              parse_mode=None)
+    return UPI_ID
+
+async def cb_set_usdt(update, context, q, d):
+    await q.edit_message_text("Setup USDT\n\nSend your BEP20 (BSC) address\n/cancel to abort", 
+                              parse_mode=None)
+    return USDT_ADDRESS
+
+# PROFILE
+async def cb_profile(update, context, q, d):
+    def fetch_profile():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT usdt_address FROM users WHERE user_id=%s", (q.from_user.id,))
-            result = c.fetchone()
+            c.execute("EXECUTE p_profile_panel(%s)", (q.from_user.id,))
+            return c.fetchone()
+
+    result = await db_run(fetch_profile)
+    
+    if result:
+        bal, approved, usdt, upi, joined = float(result['balance']), result['approved_gmail'], result['usdt_address'], result['upi_id'], result['joined_date']
+        ref_count, weekly_approvals = result['ref_count'], result['weekly_approvals']
+        rate = float(await db_run(calc_rate, q.from_user.id))
+        status_label = get_user_status_label(weekly_approvals)
         
-        if not result or not result['usdt_address']:
-            await q.answer("Please setup USDT address first", show_alert=True)
-            return
+        text = PROFILE_TPL.format(
+            status_label=status_label, bal=bal, rate=rate, approved=approved,
+            weekly_approvals=weekly_approvals, ref_count=ref_count,
+            upi=SETUP_LABELS[bool(upi)], usdt=SETUP_LABELS[bool(usdt)], joined=joined)
         
-        context.user_data['withdraw_method'] = 'usdt'
-        await q.edit_message_text(
-            "Withdraw via USDT\n\nEnter amount (Minimum: ₹100)\n\n/cancel to abort",
-            parse_mode=None
-        )
-        return WITHDRAW_AMT
-    
-    # SETUP PAYMENT
-    elif d == "setup_payment":
-        kb = [
-            [InlineKeyboardButton("📱 UPI", callback_data="set_upi")],
-            [InlineKeyboardButton("💎 USDT", callback_data="set_usdt")],
-            [InlineKeyboardButton("🔙 Back", callback_data="withdraw")]
-        ]
-        await q.edit_message_text("Setup Payment Method\n\nChoose:", 
-                                  reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
-    
-    elif d == "set_upi":
-        await q.edit_message_text("Setup UPI\n\nSend your UPI ID\n/cancel to abort", 
-                                  parse_mode=None)
-        return UPI_ID
-    
-    elif d == "set_usdt":
-        await q.edit_message_text("Setup USDT\n\nSend your BEP20 (BSC) address\n/cancel to abort", 
-                                  parse_mode=None)
-        return USDT_ADDRESS
+        await q.edit_message_text(text, reply_markup=PROFILE_MARKUP, parse_mode=None)
+
+# SETTINGS
+async def cb_settings(update, context, q, d):
+    notif = cache_get(_notif_cache, q.from_user.id)
+    if notif is None:
+        notif = await db_run(notifications_enabled, q.from_user.id)
     
-   # PROFILE
-    elif d == "profile":
+    text, markup = render_settings(notif)
+    await q.edit_message_text(text, reply_markup=markup, parse_mode=None)
+
+# TOGGLE NOTIFICATIONS
+async def cb_toggle_notif(update, context, q, d):
+    def toggle_notifications():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT balance, approved_gmail, usdt_address, upi_id, joined_date FROM users WHERE user_id=%s", 
-                     (q.from_user.id,))
-            result = c.fetchone()
-            
-            c.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id=%s AND rewarded=1", (q.from_user.id,))
-            ref_count = list(c.fetchone().values())[0]
-            
-            # Get weekly stats
-            c.execute("""
-                SELECT COUNT(*) FROM gmail
-                WHERE user_id = %s 
-                AND status = 'approved'
-                AND review_date::timestamptz >= NOW() - INTERVAL '7 days'
-            """, (q.from_user.id,))
-            weekly_approvals = list(c.fetchone().values())[0]
-        
-        if result:
-            bal, approved, usdt, upi, joined = float(result['balance']), result['approved_gmail'], result['usdt_address'], result['upi_id'], result['joined_date']
-            rate = float(calc_rate(q.from_user.id))
-            status_label = get_user_status_label(q.from_user.id)
-            
-            text = f"""Profile
-
-Status: {status_label}
-Balance: ₹{bal:.2f}
-Current rate: ₹{rate} per account
+            c.execute("""UPDATE users SET notifications_enabled = 1 - notifications_enabled
+                         WHERE user_id=%s RETURNING notifications_enabled""", (q.from_user.id,))
+            return c.fetchone()['notifications_enabled']
 
-Approved submissions (all time): {approved}
-This week: {weekly_approvals} approvals
-Successful referrals: {ref_count}
+    new_state = await db_run(toggle_notifications)
+    
+    # Write through so notify_user and settings see the new value at once
+    cache_set(_notif_cache, q.from_user.id, new_state == 1)
+    
+    await q.answer(f"{'🔔 Notifications enabled' if new_state else '🔕 Notifications disabled'}", show_alert=True)
+    text, markup = render_settings(new_state)
+    await q.edit_message_text(text, reply_markup=markup, parse_mode=None)
 
-Payment methods:
-UPI: {"✅ Setup" if upi else "❌ Not setup"}
-USDT: {"✅ Setup" if usdt else "❌ Not setup"}
+# VIEW TERMS
+async def cb_view_terms(update, context, q, d):
+    await q.edit_message_text(TERMS_TEXT, reply_markup=TERMS_MARKUP, parse_mode=None)
 
-Joined: {joined[:10]}
+# HELP
+async def cb_help(update, context, q, d):
+    await q.edit_message_text(HELP_TEXT, reply_markup=HELP_MARKUP, parse_mode=None)
 
-Note: Your rate is based on last 7 days activity"""
-            
-            kb = [
-                [InlineKeyboardButton("⚙️ Payment Methods", callback_data="setup_payment")],
-                [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-            ]
-            await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+# ADMIN PANEL
+async def cb_admin(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
     
-    # SETTINGS
-    elif d == "settings":
+    def fetch_admin_counts():
+        cached = cache_get(_admin_counts_cache, "admin")
+        if cached is not None:
+            return cached
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("SELECT notifications_enabled FROM users WHERE user_id=%s", (q.from_user.id,))
-            result = c.fetchone()
-            notif = result['notifications_enabled'] if result else 1
-        
-        text = f"""Settings
+            c = conn.cursor(cursor_factory=TupleCursor)
+            c.execute("""
+                    SELECT (SELECT COUNT(*) FROM users),
+                           (SELECT COUNT(*) FROM gmail WHERE status='pending'),
+                           (SELECT COUNT(*) FROM withdrawals WHERE status='pending')
+                """)
+            counts = c.fetchone()
+        cache_set(_admin_counts_cache, "admin", counts)
+        return counts
 
-Notifications: {"🔔 Enabled" if notif else "🔕 Disabled"}
+    users, pg, pw = await db_run(fetch_admin_counts)
+    
+    text = ADMIN_PANEL_TPL.format(users=users, pg=pg, pw=pw)
+    
+    await safe_edit_or_reply(q, text, ADMIN_PANEL_MARKUP)
 
-Support: @{SUPPORT_USERNAME}
-Terms & Conditions: Click below"""
-        
-        kb = [
-            [InlineKeyboardButton("🔕 Disable" if notif else "🔔 Enable", callback_data="toggle_notif")],
-            [InlineKeyboardButton("📜 Terms", callback_data="view_terms")],
-            [InlineKeyboardButton("📞 Support", url=f"https://t.me/{SUPPORT_USERNAME}")],
-            [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+# GMAIL QUEUE
+# GMAIL QUEUE WITH PAGINATION
+async def cb_gmail_queue(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
     
-    # TOGGLE NOTIFICATIONS
-    elif d == "toggle_notif":
+    page = validate_page(d.split("_")[-1]) if "_" in d else 0
+    offset = page * ADMIN_USERS_PER_PAGE
+    
+    def fetch_gmail_queue():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("UPDATE users SET notifications_enabled = 1 - notifications_enabled WHERE user_id=%s", 
-                     (q.from_user.id,))
-            c.execute("SELECT notifications_enabled FROM users WHERE user_id=%s", (q.from_user.id,))
-            new_state = c.fetchone().values().__iter__().__next__()
-        
-        await q.answer(f"{'🔔 Notifications enabled' if new_state else '🔕 Notifications disabled'}", show_alert=True)
-        q.data = "settings"
-        await callback(update, context)
-    
-    # VIEW TERMS
-    elif d == "view_terms":
-        text = f"""Terms & Conditions
+            refresh_gmail_queue_view(c)
+            # The window count is taken before LIMIT, so it is the total
+            c.execute("""SELECT m.user_id, u.first_name, u.username, m.cnt,
+                                COUNT(*) OVER () AS total_users
+                         FROM mv_gmail_pending_by_user m JOIN users u ON m.user_id = u.user_id
+                         ORDER BY m.cnt DESC, m.user_id
+                         LIMIT %s OFFSET %s""", (ADMIN_USERS_PER_PAGE, offset))
+            users_pending = c.fetchall()
+            total_users = users_pending[0]['total_users'] if users_pending else 0
+            return users_pending, total_users
 
-1. Submit only your own accounts
-2. No fake or stolen accounts
-3. Minimum withdrawal: ₹100
-4. Maximum {MAX_WITHDRAWALS_PER_DAY} withdrawals per day
-5. Withdrawal fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
-6. Processing time: 24-48 hours
-7. Only {', '.join(ALLOWED_DOMAINS)} allowed
-8. Referral rewards after first verified submission
-9. Suspicious activity will result in account suspension
-
-Support: @{SUPPORT_USERNAME}"""
-        
-        kb = [[InlineKeyboardButton("🔙 Back", callback_data="settings")]]
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+    users_pending, total_users = await db_run(fetch_gmail_queue)
     
-    # HELP
-    elif d == "help":
-        text = f"""📜 Help & Support – EarnX Bot
-
-📌 How it works:
-1️⃣ Submit Gmail accounts (single or bulk)
-2️⃣ Accounts go under review (24–48 hours)
-3️⃣ Approved accounts earn rewards
-4️⃣ Withdraw once balance reaches ₹100
-
-📦 Gmail Submission:
-• Single & Bulk submission supported
-• Bulk limit: 2–20 Gmail per message
-• Only gmail.com allowed
-• Duplicate / fake Gmail = rejected
-
-💰 Reward System (Rolling 7-Day Activity):
-Rates depend on LAST 7 DAYS approved Gmail:
-• 0–99 approvals → ₹20 per Gmail
-• 100–199 approvals → ₹25 per Gmail
-• 200+ approvals → ₹30 per Gmail
-
-⚠️ Important:
-• Rates are NOT lifetime locked
-• Inactivity may reduce your rate
-• Stay active to keep higher earnings
-
-🎁 Bonus Earnings:
-• Channel join: ₹1
-• Referral: ₹5 per friend
-  (after first verified submission)
-
-💵 Withdrawals:
-• Minimum: ₹100
-• Fee: {WITHDRAWAL_FEE_PERCENT}% (minimum ₹{WITHDRAWAL_FEE_MIN})
-• Limit: {MAX_WITHDRAWALS_PER_DAY} per day
-• Methods: UPI & USDT (BEP20)
-• Processing: 24–48 hours
-
-🔒 Fair Usage Policy:
-• One user = one account
-• Abuse may lead to ban
-• Admin decision is final
-
-Allowed emails:
-- {', '.join(ALLOWED_DOMAINS)}
-
-📩 Need help? Contact support:
-@{SUPPORT_USERNAME}"""
+    if users_pending:
+        total_pages = (total_users + ADMIN_USERS_PER_PAGE - 1) // ADMIN_USERS_PER_PAGE
+        parts = [f"Gmail Queue (Page {page + 1} of {total_pages})\n\n"]
+        kb = []
+        for row in users_pending:
+            uid, name, username, cnt = row['user_id'], row['first_name'], row['username'], row['cnt']
+            parts.append(f"{name} (@{username or 'N/A'}) - {cnt} pending\n")
+            kb.append([InlineKeyboardButton(f"{name} ({cnt})", callback_data=f"user_gmail_{uid}_0")])
+        text = "".join(parts)
         
-        kb = [
-            [InlineKeyboardButton("📞 Contact Support", url=f"https://t.me/{SUPPORT_USERNAME}")],
-            [InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"gmail_queue_{page-1}"))
+        if offset + ADMIN_USERS_PER_PAGE < total_users:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"gmail_queue_{page+1}"))
+        if nav:
+            kb.append(nav)
+        
+        kb.append([InlineKeyboardButton("🔙 Back", callback_data="admin")])
+        await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
+    else:
+        await q.edit_message_text("No pending Gmail submissions",
+                                 reply_markup=BACK_TO_ADMIN_MARKUP)
 
-# ADMIN PANEL
-    elif d == "admin" and q.from_user.id == ADMIN_ID:
+# Individual Gmail Review WITH PAGINATION (10 per page)
+async def cb_user_gmail(update, context, q, d):
+    parts = d.split("_")
+    uid = int(parts[2])
+    page = validate_page(parts[3]) if len(parts) > 3 else 0
+    
+    def fetch_user_gmails():
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM users")
-            users = c.fetchone().values().__iter__().__next__()
-            c.execute("SELECT COUNT(*) FROM gmail WHERE status='pending'")
-            pg = c.fetchone().values().__iter__().__next__()
-            c.execute("SELECT COUNT(*) FROM withdrawals WHERE status='pending'")
-            pw = c.fetchone().values().__iter__().__next__()
-        
-        text = f"""Admin Panel
+            return fetch_user_gmail_panel(conn.cursor(), uid, page)
 
-Total users: {users}
-Pending Gmail: {pg}
-Pending withdrawals: {pw}"""
-        
-        kb = [
-            [InlineKeyboardButton("📧 Gmail Queue", callback_data="gmail_queue")],
-            [InlineKeyboardButton("💸 Withdrawals", callback_data="withdrawal_queue")],
-            [InlineKeyboardButton("👥 User Management", callback_data="user_mgmt")],
-            [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast")],
-            [InlineKeyboardButton("📊 Statistics", callback_data="stats"),
-             InlineKeyboardButton("🔙 Back", callback_data="menu")]
-        ]
-        await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
+    gmails, total_pending, user_info = await db_run(fetch_user_gmails)
     
-    # GMAIL QUEUE
-    # GMAIL QUEUE WITH PAGINATION
-    elif d == "gmail_queue" or d.startswith("gmail_queue_"):
-        if q.from_user.id != ADMIN_ID:
+    if user_info:
+        if not gmails:
+            await q.answer("All reviewed", show_alert=True)
+            await cb_gmail_queue(update, context, q, "gmail_queue_0")
             return
         
-        page = validate_page(d.split("_")[-1]) if "_" in d else 0
-        offset = page * ADMIN_USERS_PER_PAGE
-        
+        text, markup = render_user_gmail(uid, page, gmails, total_pending, user_info)
+        await safe_edit_or_reply(q, text, markup)
+    else:
+        await q.answer("User not found", show_alert=True)
+        await cb_gmail_queue(update, context, q, "gmail_queue_0")
+
+# APPROVE SINGLE GMAIL - IDEMPOTENT & ATOMIC
+async def cb_approve_gmail(update, context, q, d):
+    parts = d.split("_")
+    gid = int(parts[1])
+    uid = int(parts[2]) if len(parts) > 2 else None
+    page = validate_page(parts[3]) if len(parts) > 3 else 0
+    
+    def approve_gmail():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("""SELECT DISTINCT u.user_id, u.first_name, u.username, COUNT(g.id) as cnt
-                         FROM gmail g JOIN users u ON g.user_id = u.user_id
-                         WHERE g.status='pending'
-                         GROUP BY u.user_id, u.first_name, u.username 
-                         ORDER BY cnt DESC 
-                         LIMIT %s OFFSET %s""", (ADMIN_USERS_PER_PAGE, offset))
-            users_pending = c.fetchall()
             
-            c.execute("""SELECT COUNT(DISTINCT user_id) 
-                         FROM gmail WHERE status='pending'""")
-            total_users = c.fetchone().values().__iter__().__next__()
-        
-        if users_pending:
-            total_pages = (total_users + ADMIN_USERS_PER_PAGE - 1) // ADMIN_USERS_PER_PAGE
-            text = f"Gmail Queue (Page {page + 1} of {total_pages})\n\n"
-            kb = []
-            for row in users_pending:
-                uid, name, username, cnt = row['user_id'], row['first_name'], row['username'], row['cnt']
-                text += f"{name} (@{username or 'N/A'}) - {cnt} pending\n"
-                kb.append([InlineKeyboardButton(f"{name} ({cnt})", callback_data=f"user_gmail_{uid}_0")])
+            # Approval, balance credit and first-approval referral reward
+            # in one atomic statement. Every CTE reads the snapshot taken
+            # before upd, so "no approved rows yet" means this is the first.
+            c.execute("""
+                    WITH upd AS (
+                        UPDATE gmail 
+                        SET status='approved', review_date=NOW() 
+                        WHERE id=%s AND status='pending'
+                        RETURNING user_id, reward, email
+                    ),
+                    prior AS (
+                        SELECT EXISTS (
+                            SELECT 1 FROM gmail g, upd
+                            WHERE g.user_id = upd.user_id AND g.status = 'approved'
+                        ) AS approved
+                    ),
+                    credit AS (
+                        UPDATE users SET balance = balance + upd.reward,
+                                         approved_gmail = approved_gmail + 1
+                        FROM upd WHERE users.user_id = upd.user_id
+                    ),
+                    ref AS (
+                        UPDATE referrals r SET rewarded = 1
+                        FROM upd, prior
+                        WHERE r.referred_id = upd.user_id AND r.rewarded = 0 AND NOT prior.approved
+                        RETURNING r.referrer_id, r.reward
+                    ),
+                    ref_credit AS (
+                        UPDATE users SET balance = balance + ref.reward
+                        FROM ref WHERE users.user_id = ref.referrer_id
+                    )
+                    SELECT upd.user_id, upd.reward, upd.email,
+                           ref.referrer_id, ref.reward AS ref_reward,
+                           (SELECT first_name FROM users WHERE user_id = upd.user_id) AS referred_name
+                    FROM upd LEFT JOIN ref ON TRUE
+                """, (gid,))
             
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"gmail_queue_{page-1}"))
-            if offset + ADMIN_USERS_PER_PAGE < total_users:
-                nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"gmail_queue_{page+1}"))
-            if nav:
-                kb.append(nav)
+            result = c.fetchone()
             
-            kb.append([InlineKeyboardButton("🔙 Back", callback_data="admin")])
-            await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
-        else:
-            await q.edit_message_text("No pending Gmail submissions",
-                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="admin")]]))
+            if not result:
+                return None
+            
+            owner = result['user_id']
+            referral = None
+            if result['referrer_id'] is not None:
+                referral = (result['referrer_id'], round_decimal(result['ref_reward']),
+                            result['referred_name'])
+            
+            # Refresh the review panel on the same connection
+            panel = fetch_user_gmail_panel(c, owner, page)
+            return owner, round_decimal(result['reward']), result['email'], referral, panel
     
-    # Individual Gmail Review WITH PAGINATION (10 per page)
-    elif d.startswith("user_gmail_"):
-        parts = d.split("_")
-        uid = int(parts[2])
-        page = validate_page(parts[3]) if len(parts) > 3 else 0
+    try:
+        approved = await db_run(approve_gmail)
+        mark_gmail_queue_stale(immediate=True)
+        
+        if not approved:
+            await q.answer("Already processed", show_alert=True)
+            return
         
-        offset = page * ADMIN_GMAIL_PER_PAGE
+        uid, reward, email, referral, panel = approved
+        cache_invalidate(_rate_cache, uid)
         
+        if referral:
+            referrer_id, ref_reward, referred_name = referral
+            await notify_user(context, referrer_id,
+                f"Referral bonus earned\n\n"
+                f"{referred_name} completed their first verified submission\n\n"
+                f"Amount credited: ₹{float(ref_reward):.2f}")
+        
+        queue_audit("approve_gmail", ADMIN_ID, uid, f"Gmail #{gid} - {email} - ₹{float(reward):.2f}")
+        
+        await notify_user(context, uid,
+            f"Gmail verified\n\n"
+            f"Email: {email}\n"
+            f"Amount credited: ₹{float(reward):.2f}\n\n"
+            f"Thank you for your submission")
+        
+        await q.answer(f"Approved - ₹{float(reward):.2f} credited", show_alert=True)
+        await show_user_gmail_panel(update, context, uid, page, panel)
+    except Exception as e:
+        logger.error(f"Error approving gmail {gid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
+
+# REJECT SINGLE GMAIL - IDEMPOTENT
+async def cb_reject_gmail(update, context, q, d):
+    parts = d.split("_")
+    gid = int(parts[1])
+    uid = int(parts[2]) if len(parts) > 2 else None
+    page = validate_page(parts[3]) if len(parts) > 3 else 0
+    
+    def reject_gmail():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("""SELECT id, email, password, reward, submit_date, status
-                        FROM gmail WHERE user_id=%s AND status='pending' 
-                        ORDER BY submit_date ASC
-                        LIMIT %s OFFSET %s""", (uid, ADMIN_GMAIL_PER_PAGE, offset))
-            gmails = c.fetchall()
             
-            c.execute("SELECT COUNT(*) FROM gmail WHERE user_id=%s AND status='pending'", (uid,))
-            total_pending = c.fetchone().values().__iter__().__next__()
+            # ATOMIC UPDATE
+            c.execute("""
+                    UPDATE gmail 
+                    SET status='rejected', review_date=NOW(), rejection_reason=%s 
+                    WHERE id=%s AND status='pending'
+                    RETURNING user_id, email
+                """, ("Wrong Password or Invalid Account", gid))
             
-            c.execute("SELECT first_name, username FROM users WHERE user_id=%s", (uid,))
-            user_info = c.fetchone()
+            result = c.fetchone()
+            if not result:
+                return None
+            panel = fetch_user_gmail_panel(c, uid if uid else result['user_id'], page)
+            return result, panel
+    
+    try:
+        rejected = await db_run(reject_gmail)
+        mark_gmail_queue_stale(immediate=True)
         
-        if user_info:
-            name, username = user_info['first_name'], user_info['username']
-            
-            if not gmails:
-                await q.answer("All reviewed", show_alert=True)
-                q.data = "gmail_queue_0"
-                await callback(update, context)
-                return
-            
-            total_pages = (total_pending + ADMIN_GMAIL_PER_PAGE - 1) // ADMIN_GMAIL_PER_PAGE
-            
-            text = f"""Gmail Review - {name}
-
-User: @{username or 'N/A'} (ID: {uid})
-Total pending: {total_pending}
-Page {page + 1} of {total_pages}
-
-"""
-            
-            for idx, gmail in enumerate(gmails, 1):
-                gid, email, pwd, reward = gmail['id'], gmail['email'], gmail['password'], float(gmail['reward'])
-                text += f"""{idx}. Gmail #{gid}
-{email}
-{pwd}
-₹{reward}
+        if not rejected:
+            await q.answer("Already processed", show_alert=True)
+            return
+        
+        result, panel = rejected
+        uid_from_db, email = result['user_id'], result['email']
+        uid = uid if uid else uid_from_db
+        
+        queue_audit("reject_gmail", ADMIN_ID, uid, f"Gmail #{gid} - {email}")
+        
+        await notify_user(context, uid,
+            f"Gmail submission rejected\n\n"
+            f"Email: {email}\n"
+            f"Reason: Wrong Password or Invalid Account\n\n"
+            f"No amount has been credited\n"
+            f"Please submit valid Gmail accounts only")
+        
+        await q.answer("Rejected", show_alert=True)
+        await show_user_gmail_panel(update, context, uid, page, panel)
+    except Exception as e:
+        logger.error(f"Error rejecting gmail {gid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
 
-"""
-            
-            kb = []
-            
-            # Batch action buttons
-            kb.append([
-                InlineKeyboardButton("✅ Approve All", callback_data=f"approve_all_{uid}"),
-                InlineKeyboardButton("❌ Reject All", callback_data=f"reject_all_{uid}")
-            ])
-            
-            # Individual Gmail buttons
-            for gmail in gmails:
-                gid = gmail['id']
-                kb.append([
-                    InlineKeyboardButton(f"✅ Approve #{gid}", callback_data=f"approve_{gid}_{uid}_{page}"),
-                    InlineKeyboardButton(f"❌ Reject #{gid}", callback_data=f"reject_{gid}_{uid}_{page}")
-                ])
+# APPROVE ALL - IDEMPOTENT & ATOMIC
+async def cb_approve_all(update, context, q, d):
+    uid = int(d.split("_")[2])
+    
+    def approve_all_gmail():
+        with get_db() as conn:
+            c = conn.cursor()
             
-            # Pagination buttons
-            nav_buttons = []
-            if page > 0:
-                nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"user_gmail_{uid}_{page-1}"))
-            if (page + 1) * ADMIN_GMAIL_PER_PAGE < total_pending:
-                nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"user_gmail_{uid}_{page+1}"))
+            # Batch approval, credit and first-approval referral reward in
+            # one statement; totals are aggregated from the updated rows
+            c.execute("""
+                    WITH upd AS (
+                        UPDATE gmail 
+                        SET status='approved', review_date=NOW() 
+                        WHERE user_id=%(uid)s AND status='pending'
+                        RETURNING id, reward, email
+                    ),
+                    totals AS (
+                        SELECT COALESCE(SUM(reward), 0) AS total, COUNT(*) AS n,
+                               (array_agg(email ORDER BY id))[1:5] AS emails
+                        FROM upd
+                    ),
+                    prior AS (
+                        SELECT EXISTS (
+                            SELECT 1 FROM gmail WHERE user_id=%(uid)s AND status='approved'
+                        ) AS approved
+                    ),
+                    credit AS (
+                        UPDATE users SET balance = balance + totals.total,
+                                         approved_gmail = approved_gmail + totals.n
+                        FROM totals WHERE users.user_id = %(uid)s AND totals.n > 0
+                    ),
+                    ref AS (
+                        UPDATE referrals r SET rewarded = 1
+                        FROM totals, prior
+                        WHERE r.referred_id = %(uid)s AND r.rewarded = 0
+                        AND totals.n > 0 AND NOT prior.approved
+                        RETURNING r.referrer_id, r.reward
+                    ),
+                    ref_credit AS (
+                        UPDATE users SET balance = balance + ref.reward
+                        FROM ref WHERE users.user_id = ref.referrer_id
+                    )
+                    SELECT totals.total, totals.n, totals.emails,
+                           ref.referrer_id, ref.reward AS ref_reward,
+                           (SELECT first_name FROM users WHERE user_id = %(uid)s) AS referred_name
+                    FROM totals LEFT JOIN ref ON TRUE
+                """, {"uid": uid})
             
-            if nav_buttons:
-                kb.append(nav_buttons)
+            result = c.fetchone()
+            count = result['n']
+            if count == 0:
+                return None
             
-            # Back button
-            kb.append([InlineKeyboardButton("🔙 Back", callback_data="gmail_queue_0")])
+            total_reward = round_decimal(result['total'])
+            referral = None
+            if result['referrer_id'] is not None:
+                referral = (result['referrer_id'], round_decimal(result['ref_reward']),
+                            result['referred_name'])
             
-            await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
-        else:
-            await q.answer("User not found", show_alert=True)
-            q.data = "gmail_queue_0"
-            await callback(update, context)
-
-    # APPROVE SINGLE GMAIL - IDEMPOTENT & ATOMIC
-    elif d.startswith("approve_") and not d.startswith("approve_all_"):
-        parts = d.split("_")
-        gid = int(parts[1])
-        uid = int(parts[2]) if len(parts) > 2 else None
-        page = validate_page(parts[3]) if len(parts) > 3 else 0
-        
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # ATOMIC UPDATE
-                c.execute("""
-                    UPDATE gmail 
-                    SET status='approved', review_date=%s 
-                    WHERE id=%s AND status='pending'
-                    RETURNING user_id, reward, email
-                """, (datetime.now().isoformat(), gid))
-                
-                result = c.fetchone()
-                
-                if not result:
-                    await q.answer("Already processed", show_alert=True)
-                    return
-                
-                uid_from_db, reward, email = result['user_id'], round_decimal(result['reward']), result['email']
-                uid = uid if uid else uid_from_db
-                
-                # Check if first approval
-                c.execute("SELECT COUNT(*) FROM gmail WHERE user_id=%s AND status='approved'", (uid,))
-                approval_count = c.fetchone().values().__iter__().__next__()
-                is_first_approval = (approval_count == 1)
-                
-                # Credit balance
-                c.execute("UPDATE users SET balance=balance+%s, approved_gmail=approved_gmail+1 WHERE user_id=%s",
-                         (reward, uid))
-                
-                # IDEMPOTENT REFERRAL REWARD
-                if is_first_approval:
-                    c.execute("""
-                        UPDATE referrals 
-                        SET rewarded=1 
-                        WHERE referred_id=%s AND rewarded=0
-                        RETURNING referrer_id, reward
-                    """, (uid,))
-                    
-                    ref_result = c.fetchone()
-                    if ref_result:
-                        referrer_id = ref_result['referrer_id']
-                        ref_reward = round_decimal(ref_result['reward'])
-                        
-                        c.execute("UPDATE users SET balance=balance+%s WHERE user_id=%s", 
-                                 (ref_reward, referrer_id))
-                        
-                        c.execute("SELECT first_name FROM users WHERE user_id=%s", (uid,))
-                        referred_name = c.fetchone()['first_name']
-                        
-                        await notify_user(context, referrer_id,
-                            f"Referral bonus earned\n\n"
-                            f"{referred_name} completed their first verified submission\n\n"
-                            f"Amount credited: ₹{float(ref_reward):.2f}")
-                
-                conn.commit()
-                
-                log_audit("approve_gmail", ADMIN_ID, uid, f"Gmail #{gid} - {email} - ₹{float(reward):.2f}")
-                
-                await notify_user(context, uid,
-                    f"Gmail verified\n\n"
-                    f"Email: {email}\n"
-                    f"Amount credited: ₹{float(reward):.2f}\n\n"
-                    f"Thank you for your submission")
-                
-                await q.answer(f"Approved - ₹{float(reward):.2f} credited", show_alert=True)
-                
-                q.data = f'user_gmail_{uid}_{page}'
-                await callback(update, context)
-        except Exception as e:
-            logger.error(f"Error approving gmail {gid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
+            log_audit("approve_all_gmail", ADMIN_ID, uid, f"{count} gmails - ₹{float(total_reward):.2f}", conn=conn)
+            return result['emails'], total_reward, count, referral
     
-    # REJECT SINGLE GMAIL - IDEMPOTENT
-    elif d.startswith("reject_") and not d.startswith("reject_all_"):
-        parts = d.split("_")
-        gid = int(parts[1])
-        uid = int(parts[2]) if len(parts) > 2 else None
-        page = validate_page(parts[3]) if len(parts) > 3 else 0
+    try:
+        approved = await db_run(approve_all_gmail)
+        mark_gmail_queue_stale(immediate=True)
         
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # ATOMIC UPDATE
-                c.execute("""
-                    UPDATE gmail 
-                    SET status='rejected', review_date=%s, rejection_reason=%s 
-                    WHERE id=%s AND status='pending'
-                    RETURNING user_id, email
-                """, (datetime.now().isoformat(), "Wrong Password or Invalid Account", gid))
-                
-                result = c.fetchone()
-                
-                if not result:
-                    await q.answer("Already processed", show_alert=True)
-                    return
-                
-                uid_from_db, email = result['user_id'], result['email']
-                uid = uid if uid else uid_from_db
-                conn.commit()
-                
-                log_audit("reject_gmail", ADMIN_ID, uid, f"Gmail #{gid} - {email}")
-                
-                await notify_user(context, uid,
-                    f"Gmail submission rejected\n\n"
-                    f"Email: {email}\n"
-                    f"Reason: Wrong Password or Invalid Account\n\n"
-                    f"No amount has been credited\n"
-                    f"Please submit valid Gmail accounts only")
-                
-                await q.answer("Rejected", show_alert=True)
-                
-                q.data = f'user_gmail_{uid}_{page}'
-                await callback(update, context)
-        except Exception as e:
-            logger.error(f"Error rejecting gmail {gid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
-
-# APPROVE ALL - IDEMPOTENT & ATOMIC
-    elif d.startswith("approve_all_"):
-        uid = int(d.split("_")[2])
+        if not approved:
+            await q.answer("No pending Gmail found", show_alert=True)
+            await cb_gmail_queue(update, context, q, "gmail_queue")
+            return
         
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # Get all pending gmails
-                c.execute("SELECT id, reward, email FROM gmail WHERE user_id=%s AND status='pending'", (uid,))
-                gmails = c.fetchall()
-                
-                if not gmails:
-                    await q.answer("No pending Gmail found", show_alert=True)
-                    q.data = "gmail_queue"
-                    await callback(update, context)
-                    return
-                
-                # Check if first approval
-                c.execute("SELECT COUNT(*) FROM gmail WHERE user_id=%s AND status='approved'", (uid,))
-                is_first_approval = c.fetchone().values().__iter__().__next__() == 0
-                
-                total_reward = sum(round_decimal(row['reward']) for row in gmails)
-                count = len(gmails)
-                
-                # ATOMIC BATCH UPDATE
-                c.execute("""
-                    UPDATE gmail 
-                    SET status='approved', review_date=%s 
-                    WHERE user_id=%s AND status='pending'
-                """, (datetime.now().isoformat(), uid))
-                
-                c.execute("UPDATE users SET balance=balance+%s, approved_gmail=approved_gmail+%s WHERE user_id=%s",
-                         (total_reward, count, uid))
-                
-                # IDEMPOTENT REFERRAL REWARD
-                if is_first_approval:
-                    c.execute("""
-                        UPDATE referrals 
-                        SET rewarded=1 
-                        WHERE referred_id=%s AND rewarded=0
-                        RETURNING referrer_id, reward
-                    """, (uid,))
-                    
-                    ref_result = c.fetchone()
-                    if ref_result:
-                        referrer_id = ref_result['referrer_id']
-                        ref_reward = round_decimal(ref_result['reward'])
-                        
-                        c.execute("UPDATE users SET balance=balance+%s WHERE user_id=%s", 
-                                 (ref_reward, referrer_id))
-                        
-                        c.execute("SELECT first_name FROM users WHERE user_id=%s", (uid,))
-                        referred_name = c.fetchone()['first_name']
-                        
-                        await notify_user(context, referrer_id,
-                            f"Referral bonus earned\n\n"
-                            f"{referred_name} completed their first verified submission\n\n"
-                            f"Amount credited: ₹{float(ref_reward):.2f}")
-                
-                conn.commit()
-                
-                log_audit("approve_all_gmail", ADMIN_ID, uid, f"{count} gmails - ₹{float(total_reward):.2f}")
-                
-                email_list = "\n".join([f"• {mask_email(g['email'])}" for g in gmails[:5]])
-                if len(gmails) > 5:
-                    email_list += f"\n• ...and {len(gmails) - 5} more"
-                
-                await notify_user(context, uid,
-                    f"All Gmail verified\n\n"
-                    f"Total verified: {count} accounts\n"
-                    f"Amount credited: ₹{float(total_reward):.2f}\n\n"
-                    f"Verified accounts:\n{email_list}\n\n"
-                    f"Your balance has been updated")
-                
-                await q.answer(f"{count} approved - ₹{float(total_reward):.2f} credited", show_alert=True)
-                
-                await safe_edit_or_reply(
-    q,
-                    f"Batch approved\n\n"
-                    f"User ID: {uid}\n"
-                    f"Gmail approved: {count}\n"
-                    f"Total amount: ₹{float(total_reward):.2f}\n\n"
-                    f"User has been notified",
-                    reply_markup=InlineKeyboardMarkup([
-    [InlineKeyboardButton("🔙 Back to Queue", callback_data="gmail_queue_0")]
-])
-)
-        except Exception as e:
-            logger.error(f"Error approving all gmails for user {uid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
+        emails, total_reward, count, referral = approved
+        cache_invalidate(_rate_cache, uid)
+        
+        if referral:
+            referrer_id, ref_reward, referred_name = referral
+            await notify_user(context, referrer_id,
+                f"Referral bonus earned\n\n"
+                f"{referred_name} completed their first verified submission\n\n"
+                f"Amount credited: ₹{float(ref_reward):.2f}")
+        
+        email_list = "\n".join([f"• {mask_email(email)}" for email in emails])
+        if count > 5:
+            email_list += f"\n• ...and {count - 5} more"
+        
+        await notify_user(context, uid,
+            f"All Gmail verified\n\n"
+            f"Total verified: {count} accounts\n"
+            f"Amount credited: ₹{float(total_reward):.2f}\n\n"
+            f"Verified accounts:\n{email_list}\n\n"
+            f"Your balance has been updated")
+        
+        await q.answer(f"{count} approved - ₹{float(total_reward):.2f} credited", show_alert=True)
+        
+        await safe_edit_or_reply(
+            q,
+            f"Batch approved\n\n"
+            f"User ID: {uid}\n"
+            f"Gmail approved: {count}\n"
+            f"Total amount: ₹{float(total_reward):.2f}\n\n"
+            f"User has been notified",
+            reply_markup=BACK_TO_GMAIL_QUEUE_MARKUP
+        )
+    except Exception as e:
+        logger.error(f"Error approving all gmails for user {uid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
+
+# REJECT ALL - ATOMIC
+async def cb_reject_all(update, context, q, d):
+    uid = int(d.split("_")[2])
     
-    # REJECT ALL - ATOMIC
-    elif d.startswith("reject_all_"):
-        uid = int(d.split("_")[2])
-        
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                c.execute("SELECT COUNT(*) FROM gmail WHERE user_id=%s AND status='pending'", (uid,))
-                count = list(c.fetchone().values())[0]
-                
-                if count == 0:
-                    await q.answer("No pending Gmail found", show_alert=True)
-                    q.data = "gmail_queue"
-                    await callback(update, context)
-                    return
-                
-                # ATOMIC BATCH UPDATE
-                c.execute("""
+    def reject_all_gmail():
+        with get_db() as conn:
+            c = conn.cursor()
+            
+            # ATOMIC BATCH UPDATE
+            c.execute("""
                     UPDATE gmail 
-                    SET status='rejected', review_date=%s, rejection_reason=%s 
+                    SET status='rejected', review_date=NOW(), rejection_reason=%s 
                     WHERE user_id=%s AND status='pending'
-                """, (datetime.now().isoformat(), "Quality issues", uid))
-                
-                conn.commit()
-                
-                log_audit("reject_all_gmail", ADMIN_ID, uid, f"{count} gmails rejected")
-                
-                await notify_user(context, uid,
-                    f"Gmail submissions rejected\n\n"
-                    f"Total rejected: {count} accounts\n"
-                    f"Reason: Quality issues\n\n"
-                    f"No amount has been credited\n"
-                    f"Please review submission guidelines")
-                
-                await q.answer(f"{count} rejected", show_alert=True)
-                
-                await safe_edit_or_reply(
-    q,
-                    f"Batch rejected\n\n"
-                    f"User ID: {uid}\n"
-                    f"Gmail rejected: {count}\n"
-                    f"Reason: Quality issues\n\n"
-                    f"User has been notified",
-                    reply_markup=InlineKeyboardMarkup([
-    [InlineKeyboardButton("🔙 Back to Queue", callback_data="gmail_queue_0")]
-])
-)
-        except Exception as e:
-            logger.error(f"Error rejecting all gmails for user {uid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
-    
-    # ==================== IMPROVED WITHDRAWAL QUEUE ====================
+                """, ("Quality issues", uid))
+            
+            return c.rowcount
     
-    # WITHDRAWAL QUEUE - Single Item View with Navigation
-    elif d == "withdrawal_queue" or d.startswith("withdrawal_queue_"):
-        if q.from_user.id != ADMIN_ID:
-            return
+    try:
+        count = await db_run(reject_all_gmail)
+        mark_gmail_queue_stale(immediate=True)
         
-        page = validate_page(d.split("_")[-1]) if "_" in d else 0
+        if count == 0:
+            await q.answer("No pending Gmail found", show_alert=True)
+            await cb_gmail_queue(update, context, q, "gmail_queue")
+            return
         
+        queue_audit("reject_all_gmail", ADMIN_ID, uid, f"{count} gmails rejected")
+        
+        await notify_user(context, uid,
+            f"Gmail submissions rejected\n\n"
+            f"Total rejected: {count} accounts\n"
+            f"Reason: Quality issues\n\n"
+            f"No amount has been credited\n"
+            f"Please review submission guidelines")
+        
+        await q.answer(f"{count} rejected", show_alert=True)
+        
+        await safe_edit_or_reply(
+            q,
+            f"Batch rejected\n\n"
+            f"User ID: {uid}\n"
+            f"Gmail rejected: {count}\n"
+            f"Reason: Quality issues\n\n"
+            f"User has been notified",
+            reply_markup=BACK_TO_GMAIL_QUEUE_MARKUP
+        )
+    except Exception as e:
+        logger.error(f"Error rejecting all gmails for user {uid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
+
+# ==================== IMPROVED WITHDRAWAL QUEUE ====================
+# WITHDRAWAL QUEUE - Single Item View with Navigation
+def fetch_withdrawal_queue_page(c, page):
+    """
+    Load the pending withdrawal at queue position `page` using cursor c, so
+    approve/reject can fetch the next card in their own transaction.
+    Returns (total_pending, withdrawal, page) with page clamped to the queue.
+    """
+    # Get total count
+    c.execute("SELECT COUNT(*) AS n FROM withdrawals WHERE status='pending'")
+    total_pending = c.fetchone()['n']
+    
+    if total_pending == 0:
+        return 0, None, page
+    
+    # Ensure page is within bounds
+    if page < 0:
+        page = 0
+    elif page >= total_pending:
+        page = total_pending - 1
+    
+    # Get single withdrawal at offset
+    c.execute("""SELECT w.id, w.amount, w.fee, w.final_amount, w.method, w.payment_info, w.request_date,
+                     u.first_name, u.username, u.user_id
+                     FROM withdrawals w JOIN users u ON w.user_id = u.user_id
+                     WHERE w.status='pending'
+                     ORDER BY w.request_date, w.id
+                     LIMIT 1 OFFSET %s""", (page,))
+    return total_pending, c.fetchone(), page
+
+async def cb_withdrawal_queue(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    page = validate_page(d.split("_")[-1]) if "_" in d else 0
+    
+    def fetch_withdrawal_at(page):
         with get_db() as conn:
-            c = conn.cursor()
-            
-            # Get total count
-            c.execute("SELECT COUNT(*) FROM withdrawals WHERE status='pending'")
-            total_pending = c.fetchone().values().__iter__().__next__()
-            
-            if total_pending == 0:
-                await safe_edit_or_reply(
-                    q,
-                    "No pending withdrawal requests",
-                    InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Back", callback_data="admin")]
-                    ])
-                )
-                return
-            
-            # Ensure page is within bounds
-            if page < 0:
-                page = 0
-            elif page >= total_pending:
-                page = total_pending - 1
-            
-            # Get single withdrawal at offset
-            c.execute("""SELECT w.id, w.amount, w.fee, w.final_amount, w.method, w.payment_info, w.request_date,
-                         u.first_name, u.username, u.user_id
-                         FROM withdrawals w JOIN users u ON w.user_id = u.user_id
-                         WHERE w.status='pending'
-                         ORDER BY w.request_date 
-                         LIMIT 1 OFFSET %s""", (page,))
-            withdrawal = c.fetchone()
-        
-        if withdrawal:
-            wid = withdrawal['id']
-            amount = float(withdrawal['amount'])
-            fee = float(withdrawal['fee'])
-            final_amount = float(withdrawal['final_amount'])
-            method = withdrawal['method']
-            info = withdrawal['payment_info']
-            date = withdrawal['request_date']
-            name = withdrawal['first_name']
-            username = withdrawal['username']
-            uid = withdrawal['user_id']
-            
-            text = f"""Withdrawal #{wid}
+            return fetch_withdrawal_queue_page(conn.cursor(), page)
+    
+    await show_withdrawal_queue(q, *await db_run(fetch_withdrawal_at, page))
+
+async def show_withdrawal_queue(q, total_pending, withdrawal, page):
+    """Render one card of the admin withdrawal queue"""
+    if total_pending == 0:
+        await safe_edit_or_reply(
+            q,
+            "No pending withdrawal requests",
+            BACK_TO_ADMIN_MARKUP
+        )
+        return
+    
+    if withdrawal:
+        wid = withdrawal['id']
+        amount = float(withdrawal['amount'])
+        fee = float(withdrawal['fee'])
+        final_amount = float(withdrawal['final_amount'])
+        method = withdrawal['method']
+        info = withdrawal['payment_info']
+        date = withdrawal['request_date']
+        name = withdrawal['first_name']
+        username = withdrawal['username']
+        uid = withdrawal['user_id']
+        
+        text = f"""Withdrawal #{wid}
 
 Position: {page + 1} of {total_pending}
 
@@ -1804,71 +2429,74 @@ Fee: ₹{fee:.2f}
 Final amount: ₹{final_amount:.2f}
 Method: {method.upper()}
 Payment info: {info}
-Date: {date[:16]}"""
-            
-            kb = []
-            
-            # Action buttons
-            kb.append([
-                InlineKeyboardButton("✅ Approve", callback_data=f"withdraw_approve_{wid}_{page}"),
-                InlineKeyboardButton("❌ Reject", callback_data=f"withdraw_reject_{wid}_{page}")
-            ])
-            
-            # Navigation buttons
-            nav = []
-            if page > 0:
-                nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"withdrawal_queue_{page-1}"))
-            if page < total_pending - 1:
-                nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"withdrawal_queue_{page+1}"))
-            if nav:
-                kb.append(nav)
-            
-            kb.append([InlineKeyboardButton("🔙 Back", callback_data="admin")])
-            
-            await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
-        else:
-            # Fallback
-            await safe_edit_or_reply(
-                q,
-                "No withdrawal found at this position",
-                InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Back", callback_data="admin")]
-                ])
-            )
-    
-    # APPROVE CONFIRMATION SCREEN
-    elif d.startswith("withdraw_approve_"):
-        if q.from_user.id != ADMIN_ID:
-            return
+Date: {date:%Y-%m-%d %H:%M}"""
+        
+        kb = []
+        
+        # Action buttons
+        kb.append([
+            InlineKeyboardButton("✅ Approve", callback_data=f"withdraw_approve_{wid}_{page}"),
+            InlineKeyboardButton("❌ Reject", callback_data=f"withdraw_reject_{wid}_{page}")
+        ])
+        
+        # Navigation buttons
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"withdrawal_queue_{page-1}"))
+        if page < total_pending - 1:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"withdrawal_queue_{page+1}"))
+        if nav:
+            kb.append(nav)
         
-        parts = d.split("_")
-        wid = int(parts[2])
-        page = int(parts[3]) if len(parts) > 3 else 0
+        kb.append([InlineKeyboardButton("🔙 Back", callback_data="admin")])
         
-        # Get withdrawal details
+        await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
+    else:
+        # Fallback
+        await safe_edit_or_reply(
+            q,
+            "No withdrawal found at this position",
+            BACK_TO_ADMIN_MARKUP
+        )
+
+# APPROVE CONFIRMATION SCREEN
+async def cb_withdraw_approve(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    parts = d.split("_")
+    wid = int(parts[2])
+    page = int(parts[3]) if len(parts) > 3 else 0
+    
+    # Get withdrawal details, or the queue card to fall back to
+    def fetch_withdrawal():
         with get_db() as conn:
             c = conn.cursor()
             c.execute("""SELECT w.amount, w.fee, w.final_amount, w.method, w.payment_info,
-                         u.first_name, u.username, u.user_id
-                         FROM withdrawals w JOIN users u ON w.user_id = u.user_id
-                         WHERE w.id=%s AND w.status='pending'""", (wid,))
+                             u.first_name, u.username, u.user_id
+                             FROM withdrawals w JOIN users u ON w.user_id = u.user_id
+                             WHERE w.id=%s AND w.status='pending'""", (wid,))
             result = c.fetchone()
-        
-        if not result:
-            await q.answer("Withdrawal already processed", show_alert=True)
-            q.data = f"withdrawal_queue_{page}"
-            await callback(update, context)
-            return
-        
-        amount = float(result['amount'])
-        final_amount = float(result['final_amount'])
-        method = result['method']
-        info = result['payment_info']
-        name = result['first_name']
-        username = result['username']
-        uid = result['user_id']
-        
-        text = f"""⚠️ Confirm Withdrawal Approval
+            if not result:
+                return None, fetch_withdrawal_queue_page(c, page)
+            return result, None
+
+    result, queue = await db_run(fetch_withdrawal)
+    
+    if not result:
+        await q.answer("Withdrawal already processed", show_alert=True)
+        await show_withdrawal_queue(q, *queue)
+        return
+    
+    amount = float(result['amount'])
+    final_amount = float(result['final_amount'])
+    method = result['method']
+    info = result['payment_info']
+    name = result['first_name']
+    username = result['username']
+    uid = result['user_id']
+    
+    text = f"""⚠️ Confirm Withdrawal Approval
 
 Withdrawal ID: #{wid}
 User: {name} (@{username or 'N/A'})
@@ -1880,98 +2508,106 @@ Method: {method.upper()}
 Payment info: {info}
 
 ⚠️ This action cannot be undone."""
-        
-        kb = [
-            [InlineKeyboardButton("✅ Confirm Approve", callback_data=f"withdraw_approve_confirm_{wid}_{page}"),
-             InlineKeyboardButton("❌ Cancel", callback_data=f"withdrawal_queue_{page}")]
-        ]
-        
-        await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
     
-    # APPROVE EXECUTION (AFTER CONFIRMATION)
-    elif d.startswith("withdraw_approve_confirm_"):
-        if q.from_user.id != ADMIN_ID:
-            return
-        
-        parts = d.split("_")
-        wid = int(parts[3])
-        page = int(parts[4]) if len(parts) > 4 else 0
-        
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # ATOMIC UPDATE
-                c.execute("""
+    kb = [
+        [InlineKeyboardButton("✅ Confirm Approve", callback_data=f"withdraw_approve_confirm_{wid}_{page}"),
+         InlineKeyboardButton("❌ Cancel", callback_data=f"withdrawal_queue_{page}")]
+    ]
+    
+    await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
+
+# APPROVE EXECUTION (AFTER CONFIRMATION)
+async def cb_withdraw_approve_confirm(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    parts = d.split("_")
+    wid = int(parts[3])
+    page = int(parts[4]) if len(parts) > 4 else 0
+    
+    def approve_withdrawal():
+        with get_db() as conn:
+            c = conn.cursor()
+            
+            # ATOMIC UPDATE
+            c.execute("""
                     UPDATE withdrawals 
-                    SET status='approved', processed_date=%s 
+                    SET status='approved', processed_date=NOW() 
                     WHERE id=%s AND status='pending'
                     RETURNING user_id, amount, final_amount
-                """, (datetime.now().isoformat(), wid))
-                
-                result = c.fetchone()
-                
-                if not result:
-                    await q.answer("Already processed", show_alert=True)
-                    q.data = f"withdrawal_queue_{page}"
-                    await callback(update, context)
-                    return
-                
-                uid, amount, final_amount = result['user_id'], float(result['amount']), float(result['final_amount'])
-                conn.commit()
-                
-                log_audit("approve_withdrawal", ADMIN_ID, uid, f"Withdrawal #{wid} - ₹{amount:.2f}")
-                
-                await notify_user(context, uid,
-                    f"Withdrawal approved\n\n"
-                    f"Withdrawal ID: #{wid}\n"
-                    f"Amount: ₹{amount:.2f}\n"
-                    f"Final amount: ₹{final_amount:.2f}\n\n"
-                    f"Payment has been processed successfully\n"
-                    f"Please check your payment method")
-                
-                await q.answer("✅ Withdrawal approved", show_alert=True)
-                
-                # Return to queue
-                q.data = f"withdrawal_queue_{page}"
-                await callback(update, context)
-                
-        except Exception as e:
-            logger.error(f"Error approving withdrawal {wid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
+                """, (wid,))
+            
+            result = c.fetchone()
+            # Next queue card, read in the same transaction
+            return result, fetch_withdrawal_queue_page(c, page)
     
-    # REJECT CONFIRMATION SCREEN
-    elif d.startswith("withdraw_reject_"):
-        if q.from_user.id != ADMIN_ID:
+    try:
+        result, queue = await db_run(approve_withdrawal)
+        
+        if not result:
+            await q.answer("Already processed", show_alert=True)
+            await show_withdrawal_queue(q, *queue)
             return
         
-        parts = d.split("_")
-        wid = int(parts[2])
-        page = int(parts[3]) if len(parts) > 3 else 0
+        uid, amount, final_amount = result['user_id'], float(result['amount']), float(result['final_amount'])
+        cache_invalidate(_admin_counts_cache, "admin")
+        
+        queue_audit("approve_withdrawal", ADMIN_ID, uid, f"Withdrawal #{wid} - ₹{amount:.2f}")
+        
+        await notify_user(context, uid,
+            f"Withdrawal approved\n\n"
+            f"Withdrawal ID: #{wid}\n"
+            f"Amount: ₹{amount:.2f}\n"
+            f"Final amount: ₹{final_amount:.2f}\n\n"
+            f"Payment has been processed successfully\n"
+            f"Please check your payment method")
         
-        # Get withdrawal details
+        await q.answer("✅ Withdrawal approved", show_alert=True)
+        
+        # Return to queue
+        await show_withdrawal_queue(q, *queue)
+            
+    except Exception as e:
+        logger.error(f"Error approving withdrawal {wid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
+
+# REJECT CONFIRMATION SCREEN
+async def cb_withdraw_reject(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    parts = d.split("_")
+    wid = int(parts[2])
+    page = int(parts[3]) if len(parts) > 3 else 0
+    
+    # Get withdrawal details, or the queue card to fall back to
+    def fetch_withdrawal():
         with get_db() as conn:
             c = conn.cursor()
             c.execute("""SELECT w.amount, w.method, w.payment_info,
-                         u.first_name, u.username, u.user_id
-                         FROM withdrawals w JOIN users u ON w.user_id = u.user_id
-                         WHERE w.id=%s AND w.status='pending'""", (wid,))
+                             u.first_name, u.username, u.user_id
+                             FROM withdrawals w JOIN users u ON w.user_id = u.user_id
+                             WHERE w.id=%s AND w.status='pending'""", (wid,))
             result = c.fetchone()
-        
-        if not result:
-            await q.answer("Withdrawal already processed", show_alert=True)
-            q.data = f"withdrawal_queue_{page}"
-            await callback(update, context)
-            return
-        
-        amount = float(result['amount'])
-        method = result['method']
-        info = result['payment_info']
-        name = result['first_name']
-        username = result['username']
-        uid = result['user_id']
-        
-        text = f"""⚠️ Confirm Withdrawal Rejection
+            if not result:
+                return None, fetch_withdrawal_queue_page(c, page)
+            return result, None
+
+    result, queue = await db_run(fetch_withdrawal)
+    
+    if not result:
+        await q.answer("Withdrawal already processed", show_alert=True)
+        await show_withdrawal_queue(q, *queue)
+        return
+    
+    amount = float(result['amount'])
+    method = result['method']
+    info = result['payment_info']
+    name = result['first_name']
+    username = result['username']
+    uid = result['user_id']
+    
+    text = f"""⚠️ Confirm Withdrawal Rejection
 
 Withdrawal ID: #{wid}
 User: {name} (@{username or 'N/A'})
@@ -1984,115 +2620,145 @@ Payment info: {info}
 The amount will be refunded to user's balance.
 
 ⚠️ Please choose rejection reason:"""
-        
-        kb = [
-            [InlineKeyboardButton("❌ Invalid Payment Info", callback_data=f"withdraw_reject_confirm_{wid}_{page}_invalid")],
-            [InlineKeyboardButton("❌ Duplicate Request", callback_data=f"withdraw_reject_confirm_{wid}_{page}_duplicate")],
-            [InlineKeyboardButton("❌ Suspicious Activity", callback_data=f"withdraw_reject_confirm_{wid}_{page}_suspicious")],
-            [InlineKeyboardButton("❌ Other Reason", callback_data=f"withdraw_reject_confirm_{wid}_{page}_other")],
-            [InlineKeyboardButton("🔙 Cancel", callback_data=f"withdrawal_queue_{page}")]
-        ]
-        
-        await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
     
-    # REJECT EXECUTION (AFTER CONFIRMATION)
-    elif d.startswith("withdraw_reject_confirm_"):
-        if q.from_user.id != ADMIN_ID:
+    kb = [
+        [InlineKeyboardButton("❌ Invalid Payment Info", callback_data=f"withdraw_reject_confirm_{wid}_{page}_invalid")],
+        [InlineKeyboardButton("❌ Duplicate Request", callback_data=f"withdraw_reject_confirm_{wid}_{page}_duplicate")],
+        [InlineKeyboardButton("❌ Suspicious Activity", callback_data=f"withdraw_reject_confirm_{wid}_{page}_suspicious")],
+        [InlineKeyboardButton("❌ Other Reason", callback_data=f"withdraw_reject_confirm_{wid}_{page}_other")],
+        [InlineKeyboardButton("🔙 Cancel", callback_data=f"withdrawal_queue_{page}")]
+    ]
+    
+    await safe_edit_or_reply(q, text, InlineKeyboardMarkup(kb))
+
+# REJECT EXECUTION (AFTER CONFIRMATION)
+async def cb_withdraw_reject_confirm(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    parts = d.split("_")
+    wid = int(parts[3])
+    page = int(parts[4])
+    reason_code = parts[5] if len(parts) > 5 else "other"
+    
+    # Map reason codes to messages
+    reason_map = {
+        "invalid": "Invalid payment information",
+        "duplicate": "Duplicate withdrawal request",
+        "suspicious": "Suspicious activity detected",
+        "other": "Does not meet withdrawal requirements"
+    }
+    
+    rejection_reason = reason_map.get(reason_code, "Does not meet withdrawal requirements")
+    
+    def reject_withdrawal():
+        with get_db() as conn:
+            c = conn.cursor()
+            
+            # ATOMIC UPDATE, with the REFUND TO BALANCE in the same statement
+            c.execute("""
+                    WITH w AS (
+                        UPDATE withdrawals 
+                        SET status='rejected', processed_date=NOW(), rejection_reason=%s 
+                        WHERE id=%s AND status='pending'
+                        RETURNING user_id, amount
+                    ), r AS (
+                        UPDATE users SET balance = balance + w.amount
+                        FROM w WHERE users.user_id = w.user_id
+                    )
+                    SELECT user_id, amount FROM w
+                """, (rejection_reason, wid))
+            
+            result = c.fetchone()
+            
+            if not result:
+                return None, fetch_withdrawal_queue_page(c, page)
+            
+            uid, amount = result['user_id'], round_decimal(result['amount'])
+            # Next queue card, read in the same transaction
+            return (uid, amount), fetch_withdrawal_queue_page(c, page)
+    
+    try:
+        rejected, queue = await db_run(reject_withdrawal)
+        
+        if not rejected:
+            await q.answer("Already processed", show_alert=True)
+            await show_withdrawal_queue(q, *queue)
             return
         
-        parts = d.split("_")
-        wid = int(parts[3])
-        page = int(parts[4])
-        reason_code = parts[5] if len(parts) > 5 else "other"
-        
-        # Map reason codes to messages
-        reason_map = {
-            "invalid": "Invalid payment information",
-            "duplicate": "Duplicate withdrawal request",
-            "suspicious": "Suspicious activity detected",
-            "other": "Does not meet withdrawal requirements"
-        }
+        uid, amount = rejected
+        cache_invalidate(_withdraw_today_cache, uid)
+        cache_invalidate(_admin_counts_cache, "admin")
         
-        rejection_reason = reason_map.get(reason_code, "Does not meet withdrawal requirements")
+        queue_audit("reject_withdrawal", ADMIN_ID, uid, f"Withdrawal #{wid} - ₹{float(amount):.2f} refunded - {rejection_reason}")
         
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # ATOMIC UPDATE
-                c.execute("""
-                    UPDATE withdrawals 
-                    SET status='rejected', processed_date=%s, rejection_reason=%s 
-                    WHERE id=%s AND status='pending'
-                    RETURNING user_id, amount
-                """, (datetime.now().isoformat(), rejection_reason, wid))
-                
-                result = c.fetchone()
-                
-                if not result:
-                    await q.answer("Already processed", show_alert=True)
-                    q.data = f"withdrawal_queue_{page}"
-                    await callback(update, context)
-                    return
-                
-                uid, amount = result['user_id'], round_decimal(result['amount'])
-                
-                # REFUND TO BALANCE
-                c.execute("UPDATE users SET balance=balance+%s WHERE user_id=%s", (amount, uid))
-                conn.commit()
-                
-                log_audit("reject_withdrawal", ADMIN_ID, uid, f"Withdrawal #{wid} - ₹{float(amount):.2f} refunded - {rejection_reason}")
-                
-                await notify_user(context, uid,
-                    f"Withdrawal rejected\n\n"
-                    f"Withdrawal ID: #{wid}\n"
-                    f"Amount: ₹{float(amount):.2f}\n"
-                    f"Reason: {rejection_reason}\n\n"
-                    f"Amount refunded to your balance\n"
-                    f"Please update your payment details and try again")
-                
-                await q.answer("❌ Withdrawal rejected and refunded", show_alert=True)
-                
-                # Return to queue
-                q.data = f"withdrawal_queue_{page}"
-                await callback(update, context)
-                
-        except Exception as e:
-            logger.error(f"Error rejecting withdrawal {wid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
+        await notify_user(context, uid,
+            f"Withdrawal rejected\n\n"
+            f"Withdrawal ID: #{wid}\n"
+            f"Amount: ₹{float(amount):.2f}\n"
+            f"Reason: {rejection_reason}\n\n"
+            f"Amount refunded to your balance\n"
+            f"Please update your payment details and try again")
+        
+        await q.answer("❌ Withdrawal rejected and refunded", show_alert=True)
+        
+        # Return to queue
+        await show_withdrawal_queue(q, *queue)
+            
+    except Exception as e:
+        logger.error(f"Error rejecting withdrawal {wid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
 
 # USER MANAGEMENT
-    elif d == "user_mgmt" and q.from_user.id == ADMIN_ID:
-        await q.edit_message_text("User Management\n\nSend user ID\n\n/cancel to abort", parse_mode=None)
-        return USER_SEARCH
+async def cb_user_mgmt(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    await q.edit_message_text("User Management\n\nSend user ID\n\n/cancel to abort", parse_mode=None)
+    return USER_SEARCH
+
+# BROADCAST
+async def cb_broadcast(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
     
-    # BROADCAST
-    elif d == "broadcast" and q.from_user.id == ADMIN_ID:
-        await q.edit_message_text("Broadcast Message\n\nSend message to all users\n\n/cancel to abort", parse_mode=None)
-        return BROADCAST_MSG
+    await q.edit_message_text("Broadcast Message\n\nSend message to all users\n\n/cancel to abort", parse_mode=None)
+    return BROADCAST_MSG
+
+# STATS
+async def cb_stats(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
     
-    # STATS
-    elif d == "stats" and q.from_user.id == ADMIN_ID:
+    def fetch_stats():
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("SELECT COUNT(*) FROM users")
-            total_users = c.fetchone().values().__iter__().__next__()
-            c.execute("SELECT COUNT(*) FROM gmail WHERE status='approved'")
-            approved = c.fetchone().values().__iter__().__next__()
-            c.execute("SELECT SUM(balance) FROM users")
-            total_bal = float(c.fetchone().values().__iter__().__next__() or 0)
-            c.execute("SELECT SUM(reward) FROM gmail WHERE status='approved'")
-            paid = float(c.fetchone().values().__iter__().__next__() or 0)
-            c.execute("SELECT COUNT(*) FROM referrals WHERE rewarded=1")
-            refs = c.fetchone().values().__iter__().__next__()
-            c.execute("SELECT SUM(reward) FROM referrals WHERE rewarded=1")
-            ref_paid = float(c.fetchone().values().__iter__().__next__() or 0)
-            c.execute("SELECT SUM(final_amount) FROM withdrawals WHERE status='approved'")
-            withdrawn = float(c.fetchone().values().__iter__().__next__() or 0)
-            c.execute("SELECT SUM(fee) FROM withdrawals WHERE status='approved'")
-            fees_collected = float(c.fetchone().values().__iter__().__next__() or 0)
-        
-        text = f"""Statistics
+            # One round trip; each table is scanned once
+            c.execute("""
+                SELECT u.total_users, u.total_bal, g.approved, g.paid,
+                       r.refs, r.ref_paid, w.withdrawn, w.fees_collected
+                FROM (SELECT COUNT(*) AS total_users,
+                             COALESCE(SUM(balance), 0) AS total_bal
+                      FROM users) u,
+                     (SELECT COUNT(*) AS approved,
+                             COALESCE(SUM(reward), 0) AS paid
+                      FROM gmail WHERE status='approved') g,
+                     (SELECT COUNT(*) AS refs,
+                             COALESCE(SUM(reward), 0) AS ref_paid
+                      FROM referrals WHERE rewarded=1) r,
+                     (SELECT COALESCE(SUM(final_amount), 0) AS withdrawn,
+                             COALESCE(SUM(fee), 0) AS fees_collected
+                      FROM withdrawals WHERE status='approved') w
+            """)
+            return c.fetchone()
+
+    row = await db_run(fetch_stats)
+    total_users, approved, refs = row['total_users'], row['approved'], row['refs']
+    total_bal, paid = float(row['total_bal']), float(row['paid'])
+    ref_paid = float(row['ref_paid'])
+    withdrawn, fees_collected = float(row['withdrawn']), float(row['fees_collected'])
+    
+    text = f"""Statistics
 
 Total users: {total_users}
 Approved Gmail: {approved}
@@ -2104,192 +2770,261 @@ Referral paid: ₹{ref_paid:.2f}
 Total paid: ₹{paid + ref_paid:.2f}
 Total withdrawn: ₹{withdrawn:.2f}
 Fees collected: ₹{fees_collected:.2f}"""
-        
-        await q.edit_message_text(text, reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔙 Back", callback_data="admin")]
-        ]), parse_mode=None)
     
-    # TOGGLE BLOCK
-    elif d.startswith("block_"):
-        uid = int(d.split("_")[1])
-        
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                c.execute("UPDATE users SET is_blocked = 1 - is_blocked WHERE user_id=%s", (uid,))
-                c.execute("SELECT is_blocked FROM users WHERE user_id=%s", (uid,))
-                blocked = c.fetchone().values().__iter__().__next__()
-                conn.commit()
-            
-            log_audit("block_user" if blocked else "unblock_user", ADMIN_ID, uid, "")
-            
-            await q.answer(f"{'Blocked' if blocked else 'Unblocked'}", show_alert=True)
-            
-            try:
-                await context.bot.send_message(
-                    uid,
-                    "Your account has been blocked" if blocked else "Your account has been unblocked"
-                )
-            except:
-                pass
-        except Exception as e:
-            logger.error(f"Error blocking/unblocking user {uid}: {e}")
-            await q.answer("Error occurred", show_alert=True)
+    await q.edit_message_text(text, reply_markup=BACK_TO_ADMIN_MARKUP, parse_mode=None)
 
-# WALLET ADD/DEDUCT - START
+# TOGGLE BLOCK
+async def cb_block_user(update, context, q, d):
+    uid = int(d.split("_")[1])
+    
+    def toggle_block():
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute("EXECUTE p_toggle_block(%s)", (uid,))
+            result = c.fetchone()
+            return result['is_blocked'] == 1 if result else None
     
-    # WALLET CONFIRM
-    elif d.startswith("wallet_confirm_"):
-        if q.from_user.id != ADMIN_ID:
+    try:
+        blocked = await db_run(toggle_block)
+        if blocked is None:
+            await q.answer("User not found", show_alert=True)
             return
         
-        parts = d.split("_")
-        uid = int(parts[2])
+        cache_set(_blocked_cache, uid, blocked)
         
-        # Get stored data
-        action = context.user_data.get('wallet_action')
-        amount = context.user_data.get('wallet_amount')
-        reason = context.user_data.get('wallet_reason')
-        balance_before = context.user_data.get('wallet_current_balance')
+        queue_audit("block_user" if blocked else "unblock_user", ADMIN_ID, uid, "")
+        
+        await q.answer(f"{'Blocked' if blocked else 'Unblocked'}", show_alert=True)
         
-        if not all([action, amount, reason, balance_before is not None]):
-            await q.answer("Session expired. Please start again.", show_alert=True)
+        try:
+            await context.bot.send_message(
+                uid,
+                "Your account has been blocked" if blocked else "Your account has been unblocked"
+            )
+        except:
+            pass
+    except Exception as e:
+        logger.error(f"Error blocking/unblocking user {uid}: {e}")
+        await q.answer("Error occurred", show_alert=True)
+
+# WALLET ADD/DEDUCT - START
+# WALLET CONFIRM
+async def cb_wallet_confirm(update, context, q, d):
+    if q.from_user.id != ADMIN_ID:
+        return
+    
+    parts = d.split("_")
+    uid = int(parts[2])
+    
+    # Get stored data
+    action = context.user_data.get('wallet_action')
+    amount = context.user_data.get('wallet_amount')
+    reason = context.user_data.get('wallet_reason')
+    balance_before = context.user_data.get('wallet_current_balance')
+    
+    if not all([action, amount, reason, balance_before is not None]):
+        await q.answer("Session expired. Please start again.", show_alert=True)
+        context.user_data.clear()
+        await q.message.reply_text(
+"Action completed. Use the menu below:",
+reply_markup=ADMIN_PANEL_BACK_MARKUP
+)
+        return
+    
+    amount = round_decimal(amount)
+    balance_before = round_decimal(balance_before)
+    
+    # Calculate new balance
+    if action == "add":
+        balance_after = balance_before + amount
+    else:  # deduct
+        balance_after = balance_before - amount
+        if balance_after < 0:
+            await q.answer("Insufficient balance", show_alert=True)
             context.user_data.clear()
             await q.message.reply_text(
-    "Action completed. Use the menu below:",
-    reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]
-    ])
+"Action completed. Use the menu below:",
+reply_markup=ADMIN_PANEL_BACK_MARKUP
 )
             return
-        
-        amount = round_decimal(amount)
-        balance_before = round_decimal(balance_before)
-        
-        # Calculate new balance
-        if action == "add":
-            balance_after = balance_before + amount
-        else:  # deduct
-            balance_after = balance_before - amount
-            if balance_after < 0:
-                await q.answer("Insufficient balance", show_alert=True)
-                context.user_data.clear()
-                await q.message.reply_text(
-    "Action completed. Use the menu below:",
-    reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]
-    ])
-)
-                return
-        
-        balance_after = round_decimal(balance_after)
-        
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                
-                # ATOMIC UPDATE
-                if action == "add":
-                    c.execute("""
+    
+    balance_after = round_decimal(balance_after)
+    
+    def apply_wallet_change():
+        with get_db() as conn:
+            c = conn.cursor()
+            
+            # ATOMIC UPDATE
+            if action == "add":
+                c.execute("""
                         UPDATE users 
                         SET balance = balance + %s
                         WHERE user_id = %s
                         RETURNING balance
                     """, (amount, uid))
-                else:  # deduct
-                    c.execute("""
+            else:  # deduct
+                c.execute("""
                         UPDATE users 
                         SET balance = balance - %s
                         WHERE user_id = %s AND balance >= %s
                         RETURNING balance
                     """, (amount, uid, amount))
-                
-                result = c.fetchone()
-                
-                if not result:
-                    await q.answer("Update failed. Balance may have changed.", show_alert=True)
-                    context.user_data.clear()
-                    await q.message.reply_text(
-    "Action completed. Use the menu below:",
-    reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]
-    ])
-)
-                    return
-                
-                final_balance = float(result['balance'])
-                
-                # Log to admin_wallet_logs
-                c.execute("""
+            
+            result = c.fetchone()
+            
+            if not result:
+                return None
+            
+            # Log to admin_wallet_logs
+            c.execute("""
                     INSERT INTO admin_wallet_logs 
                     (admin_id, user_id, action, amount, reason, balance_before, balance_after, timestamp)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
                 """, (
-                    ADMIN_ID,
-                    uid,
-                    action.upper(),
-                    amount,
-                    reason,
-                    balance_before,
-                    balance_after,
-                    datetime.now().isoformat()
-                ))
-                
-                conn.commit()
-                
-                # Log to regular audit
-                log_audit(
-                    f"wallet_{action}",
-                    ADMIN_ID,
-                    uid,
-                    f"Amount: ₹{float(amount):.2f} | Reason: {reason}"
-                )
-                
-                # Notify user
-                action_word = "added to" if action == "add" else "deducted from"
-                await notify_user(
-                    context,
-                    uid,
-                    f"₹{float(amount):.2f} has been {action_word} your wallet.\n"
-                    f"Reason: {reason}"
-                )
-                
-                # Notify admin
-                await q.answer("Balance updated successfully", show_alert=True)
-                
-                await q.message.reply_text(
-                    f"✅ Balance Update Complete\n\n"
-                    f"User ID: {uid}\n"
-                    f"Action: {action.upper()}\n"
-                    f"Amount: ₹{float(amount):.2f}\n"
-                    f"Balance before: ₹{float(balance_before):.2f}\n"
-                    f"Balance after: ₹{final_balance:.2f}\n"
-                    f"Reason: {reason}\n\n"
-                    f"User has been notified.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]
-                    ]),
-                    parse_mode=None
-                )
-
-                context.user_data.clear()
-                
-        except Exception as e:
-            logger.error(f"Error in wallet update: {e}")
-            await q.answer("Error occurred", show_alert=True)
-            context.user_data.clear()
+                ADMIN_ID,
+                uid,
+                action.upper(),
+                amount,
+                reason,
+                balance_before,
+                balance_after
+            ))
+            
+            return float(result['balance'])
     
-    # WALLET CANCEL
-    elif d == "wallet_cancel":
-        context.user_data.clear()
-        await q.answer("Cancelled", show_alert=True)
+    try:
+        final_balance = await db_run(apply_wallet_change)
+        
+        if final_balance is None:
+            await q.answer("Update failed. Balance may have changed.", show_alert=True)
+            context.user_data.clear()
+            await q.message.reply_text(
+"Action completed. Use the menu below:",
+reply_markup=ADMIN_PANEL_BACK_MARKUP
+)
+            return
+        
+        # Log to regular audit
+        queue_audit(
+            f"wallet_{action}",
+            ADMIN_ID,
+            uid,
+            f"Amount: ₹{float(amount):.2f} | Reason: {reason}"
+        )
+        
+        # Notify user
+        action_word = "added to" if action == "add" else "deducted from"
+        await notify_user(
+            context,
+            uid,
+            f"₹{float(amount):.2f} has been {action_word} your wallet.\n"
+            f"Reason: {reason}"
+        )
+        
+        # Notify admin
+        await q.answer("Balance updated successfully", show_alert=True)
+        
         await q.message.reply_text(
-    "Action completed. Use the menu below:",
-    reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔙 Admin Panel", callback_data="admin")]
-    ])
+            f"✅ Balance Update Complete\n\n"
+            f"User ID: {uid}\n"
+            f"Action: {action.upper()}\n"
+            f"Amount: ₹{float(amount):.2f}\n"
+            f"Balance before: ₹{float(balance_before):.2f}\n"
+            f"Balance after: ₹{final_balance:.2f}\n"
+            f"Reason: {reason}\n\n"
+            f"User has been notified.",
+            reply_markup=ADMIN_PANEL_BACK_MARKUP,
+            parse_mode=None
+        )
+
+        context.user_data.clear()
+            
+    except Exception as e:
+        logger.error(f"Error in wallet update: {e}")
+        await q.answer("Error occurred", show_alert=True)
+        context.user_data.clear()
+
+# WALLET CANCEL
+async def cb_wallet_cancel(update, context, q, d):
+    context.user_data.clear()
+    await q.answer("Cancelled", show_alert=True)
+    await q.message.reply_text(
+"Action completed. Use the menu below:",
+reply_markup=ADMIN_PANEL_BACK_MARKUP
 )
-        return
+    return
+
+# Exact callback_data matches
+CALLBACK_HANDLERS = {
+    "claim_channel": cb_claim_channel,
+    "menu": cb_menu,
+    "submit": cb_submit,
+    "bulk_submit": cb_bulk_submit,
+    "balance": cb_balance,
+    "earnings": cb_earnings,
+    "referral": cb_referral,
+    "referral_leaderboard": cb_referral_leaderboard,
+    "history": cb_history_gmail,
+    "withdraw": cb_withdraw,
+    "withdraw_upi": cb_withdraw_upi,
+    "withdraw_usdt": cb_withdraw_usdt,
+    "setup_payment": cb_setup_payment,
+    "set_upi": cb_set_upi,
+    "set_usdt": cb_set_usdt,
+    "profile": cb_profile,
+    "settings": cb_settings,
+    "toggle_notif": cb_toggle_notif,
+    "view_terms": cb_view_terms,
+    "help": cb_help,
+    "admin": cb_admin,
+    "gmail_queue": cb_gmail_queue,
+    "withdrawal_queue": cb_withdrawal_queue,
+    "user_mgmt": cb_user_mgmt,
+    "broadcast": cb_broadcast,
+    "stats": cb_stats,
+    "wallet_cancel": cb_wallet_cancel,
+}
+
+# Parameterised callback_data, longest prefix first so e.g. approve_all_
+# wins over approve_ and withdraw_approve_confirm_ over withdraw_approve_
+CALLBACK_PREFIX_HANDLERS = (
+    ("withdraw_approve_confirm_", cb_withdraw_approve_confirm),
+    ("withdraw_reject_confirm_", cb_withdraw_reject_confirm),
+    ("history_withdrawal_", cb_history_withdrawal),
+    ("withdrawal_queue_", cb_withdrawal_queue),
+    ("withdraw_approve_", cb_withdraw_approve),
+    ("withdraw_reject_", cb_withdraw_reject),
+    ("wallet_confirm_", cb_wallet_confirm),
+    ("history_gmail_", cb_history_gmail),
+    ("gmail_queue_", cb_gmail_queue),
+    ("approve_all_", cb_approve_all),
+    ("user_gmail_", cb_user_gmail),
+    ("reject_all_", cb_reject_all),
+    ("earnings_", cb_earnings),
+    ("approve_", cb_approve_gmail),
+    ("reject_", cb_reject_gmail),
+    ("block_", cb_block_user),
+)
+
+async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    
+    if q.from_user.id != ADMIN_ID:
+        # Cache hits skip the executor hop
+        blocked = cache_get(_blocked_cache, q.from_user.id)
+        if blocked is None:
+            blocked = await db_run(is_blocked, q.from_user.id)
+        if blocked:
+            await q.answer("Your account is blocked", show_alert=True)
+            return
+    
+    d = q.data
+    handler = CALLBACK_HANDLERS.get(d)
+    if handler is None:
+        handler = next((h for prefix, h in CALLBACK_PREFIX_HANDLERS if d.startswith(prefix)), None)
+    if handler:
+        return await handler(update, context, q, d)
 
 async def start_wallet_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Entry point for wallet add/deduct operations"""
@@ -2306,10 +3041,13 @@ async def start_wallet_operation(update: Update, context: ContextTypes.DEFAULT_T
     uid = int(parts[2])
     
     # Verify user exists
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT first_name, balance FROM users WHERE user_id=%s", (uid,))
-        result = c.fetchone()
+    def fetch_target():
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute("SELECT first_name, balance FROM users WHERE user_id=%s", (uid,))
+            return c.fetchone()
+
+    result = await db_run(fetch_target)
     
     if not result:
         await q.answer("User not found", show_alert=True)
@@ -2352,7 +3090,7 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     email = result
     
-    duplicate = check_duplicate_email(email)
+    duplicate = await db_run(check_duplicate_email, email)
     if duplicate:
         duplicate_status = duplicate['status']
         duplicate_user = duplicate['user_id']
@@ -2394,55 +3132,45 @@ async def receive_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     uid = update.effective_user.id
     email = context.user_data['email']
-    reward = calc_rate(uid)
     
-    try:
+    def submit_gmail():
+        reward = calc_rate(uid)
         with get_db() as conn:
             c = conn.cursor()
-            c.execute("""INSERT INTO gmail (user_id, email, password, reward, submit_date)
-                         VALUES (%s, %s, %s, %s, %s) RETURNING id""",
-                      (uid, email, pwd, reward, datetime.now().isoformat()))
-            gid = c.fetchone()['id']
-            c.execute("UPDATE users SET total_gmail=total_gmail+1 WHERE user_id=%s", (uid,))
-        
-        update_submit_time(uid)
+            c.execute("EXECUTE p_gmail_insert(%s, %s, %s, %s, %s)",
+                      (uid, email, pwd, reward, normalize_email(email)))
+            inserted = c.fetchone()
+        return (inserted['id'] if inserted else None), reward
+    
+    try:
+        gid, reward = await db_run(submit_gmail)
+        if gid is None:
+            context.user_data.clear()
+            await update.message.reply_text(
+                "Duplicate submission\n\n"
+                "This email was already submitted.",
+                parse_mode=None
+            )
+            return ConversationHandler.END
+        mark_gmail_queue_stale()
         
         context.user_data.clear()
         
-        kb = [[InlineKeyboardButton("🔙 Menu", callback_data="menu")]]
-        await update.message.reply_text(
+        await reply_and_notify_admin(
+            update, context,
             f"Submission successful\n\n"
             f"ID: #{gid}\n"
             f"Email: {mask_email(email)}\n"
             f"Reward: ₹{float(reward)}\n\n"
             f"Under review (24-48 hours)",
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode=None
+            ADMIN_NEW_GMAIL_TPL.format(
+                name=update.effective_user.first_name, username=update.effective_user.username,
+                uid=uid, email=email, pwd=pwd, reward=float(reward)),
+            reply_markup=MENU_MARKUP
         )
         
-        try:
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"New Gmail Submission\n\n"
-                f"User: {update.effective_user.first_name} (@{update.effective_user.username})\n"
-                f"User ID: {uid}\n\n"
-                f"Email: {email}\n"
-                f"Password: {pwd}\n"
-                f"Reward: ₹{float(reward)}",
-                parse_mode=None
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify admin: {e}")
-        
         return ConversationHandler.END
         
-    except psycopg2.IntegrityError:
-        await update.message.reply_text(
-            "Duplicate submission\n\n"
-            "This email was already submitted.",
-            parse_mode=None
-        )
-        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error in receive_password: {e}")
         await update.message.reply_text(
@@ -2458,7 +3186,7 @@ async def receive_bulk_gmail(update: Update, context: ContextTypes.DEFAULT_TYPE)
     uid = update.effective_user.id
 
     # ✅ ADD THIS BLOCK HERE (EXACTLY HERE)
-    can_submit, wait_time = can_submit_gmail(uid)
+    can_submit, wait_time = await db_run(can_submit_gmail, uid)
     if not can_submit:
         await update.message.reply_text(
             f"Please wait {wait_time} seconds before submitting again.",
@@ -2494,18 +3222,19 @@ async def receive_bulk_gmail(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return BULK_GMAIL
     
-    # Parse and validate each line
-    valid_accounts = []
+    # Parse and validate each line; errors are (line, message) so duplicate
+    # errors found afterwards still list in line order
+    candidates = []
     errors = []
     
     for idx, line in enumerate(lines, 1):
         if '|' not in line:
-            errors.append(f"Line {idx}: Missing separator '|'")
+            errors.append((idx, "Missing separator '|'"))
             continue
         
         parts = line.split('|', 1)
         if len(parts) != 2:
-            errors.append(f"Line {idx}: Invalid format")
+            errors.append((idx, "Invalid format"))
             continue
         
         email = parts[0].strip()
@@ -2514,23 +3243,35 @@ async def receive_bulk_gmail(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Validate email
         is_valid, result = validate_email(email)
         if not is_valid:
-            errors.append(f"Line {idx}: {result}")
+            errors.append((idx, result))
             continue
         
         email = result
         
         # Validate password
         if not validate_password(password):
-            errors.append(f"Line {idx}: Password must be 6-100 characters")
-            continue
-        
-        # Check duplicate
-        duplicate = check_duplicate_email(email)
-        if duplicate:
-            errors.append(f"Line {idx}: Email already submitted")
+            errors.append((idx, "Password must be 6-100 characters"))
             continue
         
-        valid_accounts.append((email, password))
+        candidates.append((idx, email, password, normalize_email(email)))
+    
+    # Check duplicates for all lines in one query
+    submitted = set()
+    if candidates:
+        submitted = await db_run(find_submitted_emails, [key for *_, key in candidates])
+    valid_accounts = []
+    # ON CONFLICT would silently drop a repeat within the paste, so report it;
+    # the first occurrence is the one submitted
+    seen = set()
+    for idx, email, password, key in candidates:
+        if key in submitted:
+            errors.append((idx, "Email already submitted"))
+        elif key in seen:
+            errors.append((idx, "Duplicate in this submission"))
+        else:
+            seen.add(key)
+            valid_accounts.append((email, password, key))
+    errors = [f"Line {idx}: {message}" for idx, message in sorted(errors)]
     
     # If no valid accounts
     if not valid_accounts:
@@ -2544,31 +3285,29 @@ async def receive_bulk_gmail(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return BULK_GMAIL
     
-    # Calculate reward
-    reward = calc_rate(uid)
-    
     # Insert all valid accounts atomically
-    try:
-        inserted_ids = []
+    def submit_bulk():
+        reward = calc_rate(uid)
         with get_db() as conn:
-            c = conn.cursor()
+            c = conn.cursor(cursor_factory=TupleCursor)
             
-            for email, password in valid_accounts:
-                try:
-                    c.execute("""INSERT INTO gmail (user_id, email, password, reward, submit_date)
-                                 VALUES (%s, %s, %s, %s, %s) RETURNING id""",
-                              (uid, email, password, reward, datetime.now().isoformat()))
-                    gid = c.fetchone()['id']
-                    inserted_ids.append((gid, email))
-                except psycopg2.IntegrityError:
-                    # Skip duplicates that appeared during batch processing
-                    continue
+            # One multi-row INSERT; duplicates that appeared during batch
+            # processing are skipped and return no row
+            inserted_ids = execute_values(c,
+                """INSERT INTO gmail (user_id, email, password, reward, submit_date, email_key)
+                   VALUES %s ON CONFLICT (email_key) DO NOTHING RETURNING id, email""",
+                [(uid, email, password, reward, key) for email, password, key in valid_accounts],
+                template="(%s, %s, %s, %s, NOW(), %s)", fetch=True)
             
             # Update total count
-            c.execute("UPDATE users SET total_gmail=total_gmail+%s WHERE user_id=%s", 
+            c.execute("UPDATE users SET total_gmail=total_gmail+%s, last_submit_time=NOW() WHERE user_id=%s",
                      (len(inserted_ids), uid))
+        return inserted_ids, reward
+    
+    try:
+        inserted_ids, reward = await db_run(submit_bulk)
+        mark_gmail_queue_stale()
         
-        update_submit_time(uid)
         context.user_data.clear()
         
         # Success message
@@ -2584,27 +3323,19 @@ async def receive_bulk_gmail(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         success_text += "\n\nUnder review (24-48 hours)"
         
-        kb = [[InlineKeyboardButton("🔙 Menu", callback_data="menu")]]
-        await update.message.reply_text(success_text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=None)
+        admin_text = ADMIN_BULK_GMAIL_TPL.format(
+            name=update.effective_user.first_name, username=update.effective_user.username,
+            uid=uid, count=len(inserted_ids), reward=float(reward))
         
-        # Notify admin
-        try:
-            admin_text = f"Bulk Gmail Submission\n\n"
-            admin_text += f"User: {update.effective_user.first_name} (@{update.effective_user.username})\n"
-            admin_text += f"User ID: {uid}\n"
-            admin_text += f"Count: {len(inserted_ids)} accounts\n"
-            admin_text += f"Reward: ₹{float(reward)} each\n\n"
-            
-            # Show first 5 accounts
-            for idx, (gid, email) in enumerate(inserted_ids[:5], 1):
-                admin_text += f"{idx}. #{gid} - {email}\n"
-            
-            if len(inserted_ids) > 5:
-                admin_text += f"\n...and {len(inserted_ids) - 5} more"
-            
-            await context.bot.send_message(ADMIN_ID, admin_text, parse_mode=None)
-        except Exception as e:
-            logger.error(f"Failed to notify admin: {e}")
+        # Show first 5 accounts
+        admin_text += "".join(f"{idx}. #{gid} - {email}\n"
+                              for idx, (gid, email) in enumerate(inserted_ids[:5], 1))
+        
+        if len(inserted_ids) > 5:
+            admin_text += f"\n...and {len(inserted_ids) - 5} more"
+        
+        await reply_and_notify_admin(update, context, success_text, admin_text,
+                                     reply_markup=MENU_MARKUP)
         
         return ConversationHandler.END
         
@@ -2630,15 +3361,19 @@ async def receive_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return UPI_ID
     
     try:
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("UPDATE users SET upi_id=%s WHERE user_id=%s", (upi_id, update.effective_user.id))
+        def save_upi():
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute("UPDATE users SET upi_id=%s WHERE user_id=%s", (upi_id, update.effective_user.id))
+
+        await db_run(save_upi)
+        if 'withdraw_payment' in context.user_data:
+            context.user_data['withdraw_payment']['upi'] = upi_id
         
-        kb = [[InlineKeyboardButton("🔙 Profile", callback_data="profile")]]
         await update.message.reply_text(
             f"UPI ID saved\n\n"
             f"UPI: {upi_id}",
-            reply_markup=InlineKeyboardMarkup(kb),
+            reply_markup=BACK_TO_PROFILE_MARKUP,
             parse_mode=None
         )
         return ConversationHandler.END
@@ -2665,15 +3400,19 @@ async def receive_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return USDT_ADDRESS
     
     try:
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("UPDATE users SET usdt_address=%s WHERE user_id=%s", (addr, update.effective_user.id))
+        def save_usdt():
+            with get_db() as conn:
+                c = conn.cursor()
+                c.execute("UPDATE users SET usdt_address=%s WHERE user_id=%s", (addr, update.effective_user.id))
+
+        await db_run(save_usdt)
+        if 'withdraw_payment' in context.user_data:
+            context.user_data['withdraw_payment']['usdt'] = addr
         
-        kb = [[InlineKeyboardButton("🔙 Profile", callback_data="profile")]]
         await update.message.reply_text(
             f"USDT address saved\n\n"
             f"Address: {addr[:10]}...{addr[-10:]}",
-            reply_markup=InlineKeyboardMarkup(kb),
+            reply_markup=BACK_TO_PROFILE_MARKUP,
             parse_mode=None
         )
         return ConversationHandler.END
@@ -2698,7 +3437,7 @@ async def receive_withdraw_amt(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return WITHDRAW_AMT
         
-        can_withdraw, remaining = can_withdraw_today(update.effective_user.id)
+        can_withdraw, remaining = await db_run(can_withdraw_today, update.effective_user.id)
         if not can_withdraw:
             await update.message.reply_text(
                 f"Daily limit reached\n\n"
@@ -2712,56 +3451,17 @@ async def receive_withdraw_amt(update: Update, context: ContextTypes.DEFAULT_TYP
         
         fee, final_amount = calculate_withdrawal_fee(amount)
         
-        try:
+        method_name = "UPI" if method == 'upi' else "USDT BEP20"
+        
+        def submit_withdrawal():
             with get_db() as conn:
                 c = conn.cursor()
-                
-                c.execute("SELECT balance, usdt_address, upi_id FROM users WHERE user_id=%s", 
-                         (update.effective_user.id,))
-                result = c.fetchone()
-                
-                if not result:
-                    await update.message.reply_text("Error occurred")
-                    return ConversationHandler.END
-                
-                balance = round_decimal(result['balance'])
-                
-                if amount > balance:
-                    await update.message.reply_text(
-                        f"Insufficient balance\n\n"
-                        f"Balance: ₹{float(balance):.2f}\n"
-                        f"Requested: ₹{float(amount):.2f}",
-                        parse_mode=None
-                    )
-                    return WITHDRAW_AMT
-                
-                payment_info = result['upi_id'] if method == 'upi' else result['usdt_address']
-                method_name = "UPI" if method == 'upi' else "USDT BEP20"
-                
-                # ATOMIC DEDUCTION
-                c.execute("""
-                    UPDATE users 
-                    SET balance=balance-%s 
-                    WHERE user_id=%s AND balance >= %s
-                    RETURNING balance
-                """, (amount, update.effective_user.id, amount))
-                
-                updated = c.fetchone()
-                
-                if not updated:
-                    await update.message.reply_text(
-                        "Insufficient balance\n\n"
-                        "Your balance may have changed. Please try again.",
-                        parse_mode=None
-                    )
-                    return ConversationHandler.END
-                
-                c.execute("""INSERT INTO withdrawals (user_id, amount, fee, final_amount, method, payment_info, request_date)
-                             VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-                         (update.effective_user.id, amount, fee, final_amount, method, payment_info, datetime.now().isoformat()))
-                wid = c.fetchone()['id']
-                
-                conn.commit()
+                c.execute("EXECUTE p_withdraw_submit(%s, %s, %s, %s, %s)",
+                         (update.effective_user.id, amount, fee, final_amount, method))
+                return c.fetchone()
+        
+        try:
+            result = await db_run(submit_withdrawal)
         except Exception as e:
             logger.error(f"Error in withdrawal transaction: {e}")
             await update.message.reply_text(
@@ -2771,10 +3471,34 @@ async def receive_withdraw_amt(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return ConversationHandler.END
         
+        if not result:
+            await update.message.reply_text("Error occurred")
+            return ConversationHandler.END
+        
+        if result['id'] is None:
+            balance = round_decimal(result['balance'])
+            if amount > balance:
+                await update.message.reply_text(
+                    f"Insufficient balance\n\n"
+                    f"Balance: ₹{float(balance):.2f}\n"
+                    f"Requested: ₹{float(amount):.2f}",
+                    parse_mode=None
+                )
+                return WITHDRAW_AMT
+            await update.message.reply_text(
+                "Insufficient balance\n\n"
+                "Your balance may have changed. Please try again.",
+                parse_mode=None
+            )
+            return ConversationHandler.END
+        
+        wid, payment_info = result['id'], result['payment_info']
+        cache_invalidate(_withdraw_today_cache, update.effective_user.id)
+        cache_invalidate(_admin_counts_cache, "admin")
         context.user_data.clear()
         
-        kb = [[InlineKeyboardButton("🔙 Menu", callback_data="menu")]]
-        await update.message.reply_text(
+        await reply_and_notify_admin(
+            update, context,
             f"Withdrawal requested\n\n"
             f"ID: #{wid}\n"
             f"Amount: ₹{float(amount):.2f}\n"
@@ -2782,26 +3506,13 @@ async def receive_withdraw_amt(update: Update, context: ContextTypes.DEFAULT_TYP
             f"Final amount: ₹{float(final_amount):.2f}\n"
             f"Method: {method_name}\n\n"
             f"Processing within 24-48 hours",
-            reply_markup=InlineKeyboardMarkup(kb),
-            parse_mode=None
+            ADMIN_NEW_WITHDRAWAL_TPL.format(
+                name=update.effective_user.first_name, uid=update.effective_user.id,
+                amount=float(amount), fee=float(fee), final=float(final_amount),
+                method=method_name, payment_info=payment_info),
+            reply_markup=MENU_MARKUP
         )
         
-        try:
-            await context.bot.send_message(
-                ADMIN_ID,
-                f"New Withdrawal Request\n\n"
-                f"User: {update.effective_user.first_name}\n"
-                f"User ID: {update.effective_user.id}\n\n"
-                f"Amount: ₹{float(amount):.2f}\n"
-                f"Fee: ₹{float(fee):.2f}\n"
-                f"Final: ₹{float(final_amount):.2f}\n"
-                f"Method: {method_name}\n"
-                f"Payment info: {payment_info}",
-                parse_mode=None
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify admin: {e}")
-        
         return ConversationHandler.END
         
     except ValueError:
@@ -2834,17 +3545,18 @@ async def receive_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         uid = int(user_input)
         
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT username, first_name, balance, total_gmail, approved_gmail, 
-                         is_blocked, joined_date FROM users WHERE user_id=%s""", (uid,))
-            result = c.fetchone()
+        def fetch_user():
+            with get_db() as conn:
+                c = conn.cursor(cursor_factory=TupleCursor)
+                c.execute("""SELECT username, first_name, balance, total_gmail, approved_gmail, 
+                             is_blocked, joined_date FROM users WHERE user_id=%s""", (uid,))
+                return c.fetchone()
+        
+        result = await db_run(fetch_user)
         
         if result:
-            username, name, bal, total, approved, blocked, joined = (
-                result['username'], result['first_name'], float(result['balance']), 
-                result['total_gmail'], result['approved_gmail'], result['is_blocked'], result['joined_date']
-            )
+            username, name, bal, total, approved, blocked, joined = result
+            bal = float(bal)
             status = "Blocked" if blocked else "Active"
             
             text = f"""User Information
@@ -2856,7 +3568,7 @@ Status: {status}
 
 Balance: ₹{bal:.2f}
 Gmail: {approved}/{total}
-Joined: {joined[:10]}"""
+Joined: {joined:%Y-%m-%d}"""
             
             kb = [
                 [InlineKeyboardButton("➕ Add Balance", callback_data=f"wallet_add_{uid}"),
@@ -2882,32 +3594,57 @@ Joined: {joined[:10]}"""
 
 async def receive_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message.text
+    text = f"Announcement\n\n{msg}"
     
-    try:
+    async def send(user_id):
+        if user_id in _unreachable_users:
+            return False
+        try:
+            async with _send_limiter:
+                await context.bot.send_message(user_id, text, parse_mode=None)
+            return True
+        except Forbidden:
+            mark_unreachable(user_id)
+            return False
+        except Exception as e:
+            logger.error(f"Failed to send broadcast to {user_id}: {e}")
+            return False
+    
+    def fetch_recipients(after_id):
         with get_db() as conn:
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM users WHERE is_blocked=0")
-            users = c.fetchall()
-        
-        sent = 0
-        failed = 0
-        for row in users:
-            try:
-                await context.bot.send_message(row['user_id'], f"Announcement\n\n{msg}", parse_mode=None)
-                sent += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"Failed to send broadcast to {row['user_id']}: {e}")
-        
-        log_audit("broadcast", ADMIN_ID, None, f"Sent: {sent}, Failed: {failed}")
+            c = conn.cursor(cursor_factory=TupleCursor)
+            c.execute("""
+                SELECT user_id FROM users
+                WHERE is_blocked=0 AND bot_blocked=0 AND user_id > %s
+                ORDER BY user_id LIMIT %s
+            """, (after_id, BROADCAST_BATCH_SIZE))
+            return [user_id for (user_id,) in c.fetchall()]
+    
+    try:
+        # Recipients are paged by user_id so memory stays flat and no pooled
+        # connection is held while a batch is being sent. Sends within a batch
+        # run concurrently, paced by the shared rate limiter.
+        sent = failed = 0
+        last_id = 0
+        while True:
+            batch = await db_run(fetch_recipients, last_id)
+            if not batch:
+                break
+            results = await asyncio.gather(*(send(user_id) for user_id in batch))
+            sent += sum(results)
+            failed += len(results) - sum(results)
+            last_id = batch[-1]
+            if len(batch) < BROADCAST_BATCH_SIZE:
+                break
+        
+        queue_audit("broadcast", ADMIN_ID, None, f"Sent: {sent}, Failed: {failed}")
         
-        kb = [[InlineKeyboardButton("🔙 Admin", callback_data="admin")]]
         await update.message.reply_text(
             f"Broadcast complete\n\n"
             f"Sent: {sent}\n"
             f"Failed: {failed}\n"
-            f"Total: {len(users)} users",
-            reply_markup=InlineKeyboardMarkup(kb),
+            f"Total: {sent + failed} users",
+            reply_markup=ADMIN_BACK_MARKUP,
             parse_mode=None
         )
         
@@ -3040,8 +3777,7 @@ Reason: {reason}
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
-    kb = [[InlineKeyboardButton("🔙 Menu", callback_data="menu")]]
-    await update.message.reply_text("Cancelled", reply_markup=InlineKeyboardMarkup(kb))
+    await update.message.reply_text("Cancelled", reply_markup=MENU_MARKUP)
     return ConversationHandler.END
 
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3051,10 +3787,9 @@ async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYP
     if text in ['start', 'menu', 'hi', 'hello', 'hey']:
         await start(update, context)
     else:
-        kb = [[InlineKeyboardButton("Main Menu", callback_data="menu")]]
         await update.message.reply_text(
             "Use the buttons below to navigate:",
-            reply_markup=InlineKeyboardMarkup(kb)
+            reply_markup=MAIN_MENU_BUTTON_MARKUP
         )
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -3076,41 +3811,46 @@ async def auto_message_worker(app: Application):
     """Send auto engagement messages every 6 hours"""
     await asyncio.sleep(30)  # wait for bot startup
 
-    while True:
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-
-                # Check if auto messages are enabled
-                c.execute("SELECT value FROM system_flags WHERE key='auto_messages_enabled'")
-                flag = c.fetchone()
-                if not flag or flag['value'] != 'true':
-                    await asyncio.sleep(3600)
-                    continue
+    def fetch_auto_message():
+        with get_db() as conn:
+            c = conn.cursor()
 
-                # Get one random active message
-                c.execute("""
-                    SELECT message FROM auto_messages
-                    WHERE is_active = TRUE
-                    ORDER BY RANDOM()
-                    LIMIT 1
-                """)
-                msg = c.fetchone()
-                if not msg:
-                    await asyncio.sleep(3600)
-                    continue
+            # Check if auto messages are enabled
+            c.execute("SELECT value FROM system_flags WHERE key='auto_messages_enabled'")
+            flag = c.fetchone()
+            if not flag or flag['value'] != 'true':
+                return None
 
-                message_text = msg['message']
+            # Get one random active message
+            c.execute("""
+                SELECT message FROM auto_messages
+                WHERE is_active = TRUE
+                ORDER BY RANDOM()
+                LIMIT 1
+            """)
+            msg = c.fetchone()
+            if not msg:
+                return None
+
+            # Get all active users
+            c.execute("SELECT user_id FROM users WHERE is_blocked = 0 AND bot_blocked = 0")
+            return msg['message'], c.fetchall()
 
-                # Get all active users
-                c.execute("SELECT user_id FROM users WHERE is_blocked = 0")
-                users = c.fetchall()
+    while True:
+        try:
+            auto_message = await db_run(fetch_auto_message)
+            if auto_message is None:
+                await asyncio.sleep(3600)
+                continue
+            message_text, users = auto_message
 
             sent = 0
             for u in users:
                 try:
                     await app.bot.send_message(u['user_id'], message_text, parse_mode=None)
                     sent += 1
+                except Forbidden:
+                    mark_unreachable(u['user_id'])
                 except:
                     pass
 
@@ -3127,6 +3867,20 @@ async def post_init(application):
     Runs after bot starts and event loop is ready
     """
     application.create_task(auto_message_worker(application))
+    application.bot_data["audit_writer"] = spawn(audit_writer())
+    application.bot_data["notify_worker"] = spawn(notify_worker())
+
+async def post_stop(application):
+    """Flush queued notifications and audit entries, then close pooled connections"""
+    notifier = application.bot_data.get("notify_worker")
+    if notifier:
+        await _notify_queue.put(None)
+        await notifier
+    writer = application.bot_data.get("audit_writer")
+    if writer:
+        await _audit_queue.put(None)
+        await writer
+    db_pool.closeall()
 
 def main():
     print("Starting bot...")
@@ -3135,7 +3889,7 @@ def main():
 
     init_db()
 
-    app = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    app = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).build()
 
     # Conversation handlers
     gmail_conv = ConversationHandler(